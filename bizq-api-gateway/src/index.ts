@@ -78,6 +78,7 @@ app.get('/api/services/health', async (req, res) => {
 app.use('/api/suggestions', createProxyMiddleware({
   target: config.services['search-suggestions'],
   changeOrigin: true,
+  xfwd: true,
   pathRewrite: {
     '^/api/suggestions': '/api/suggestions'
   },
@@ -101,6 +102,7 @@ app.use('/api/suggestions', createProxyMiddleware({
 app.use('/api/domains', createProxyMiddleware({
   target: config.services['domain-suggestions'],
   changeOrigin: true,
+  xfwd: true,
   pathRewrite: {
     '^/api/domains': '/api'
   },
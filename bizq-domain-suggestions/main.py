@@ -1,17 +1,29 @@
 import asyncio
+import json
 import logging
+import os
+import re
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from typing import List, Optional, Dict, Any
+from typing import AsyncIterator, List, Literal, Optional, Dict, Any, Set, Tuple
+import msgpack
 import structlog
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, field_validator
 import redis.asyncio as redis
 import whois
 from openai import AsyncOpenAI
 import httpx
 
+from name_generator import NameGenerator
+from registered_filter import RegisteredNameFilter
+
 # Configure structured logging
 structlog.configure(
     processors=[
@@ -40,67 +52,195 @@ class Settings:
     port: int = 3002
     rate_limit_requests: int = 50
     rate_limit_window: int = 3600  # 1 hour
+    rate_limit_local_clients: int = 10000  # clients tracked per worker while Redis is down
+    # Proxies whose X-Forwarded-For is trusted for the client address ("*" for any)
+    forwarded_allow_ips: str = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+    whois_concurrency: int = 8  # simultaneous WHOIS lookups per worker
+    whois_timeout: float = 5.0  # seconds per lookup
+    availability_deadline: float = 8.0  # seconds for all lookups of one request
+    availability_ttl_taken: int = 7 * 86400  # registered names rarely free up
+    availability_ttl_available: int = 900  # free names can be registered any minute
+    availability_ttl_failed: int = 60  # back off briefly after a failed lookup
+    cache_compress_min_bytes: int = 512  # zlib-compress cached lists larger than this
+    registered_filter_path: str = "registered.bloom"  # built by registered_filter.py; optional
+    registered_filter_check_interval: float = 30.0  # seconds between checks for a new filter file
+    suggestion_engine: str = "auto"  # auto (AI, local fill-in), local or ai
+    ai_timeout: float = 4.0  # seconds auto mode waits for the AI before filling in locally
 
 settings = Settings()
 
+# Labels like "com", "io" or "co.uk"
+TLD_PATTERN = re.compile(r"[a-z0-9-]{2,63}(\.[a-z0-9-]{2,63})?")
+
 # Pydantic models
 class DomainSuggestionRequest(BaseModel):
     industry: str = Field(..., description="Business industry/sector")
     keywords: List[str] = Field(default_factory=list, description="Keywords describing the business")
     limit: int = Field(default=10, ge=1, le=20, description="Number of suggestions to return")
     check_availability: bool = Field(default=True, description="Check domain availability")
+    tlds: List[str] = Field(default_factory=lambda: ["com"], min_length=1, max_length=10,
+                            description="Top-level domains to check each name against")
+    engine: Optional[Literal["auto", "local", "ai"]] = Field(
+        default=None, description="Name generator; defaults to the service's suggestion_engine"
+    )
+
+    @field_validator("tlds")
+    @classmethod
+    def normalize_tlds(cls, tlds: List[str]) -> List[str]:
+        normalized = list(dict.fromkeys(tld.strip().lstrip(".").lower() for tld in tlds))
+        for tld in normalized:
+            if not TLD_PATTERN.fullmatch(tld):
+                raise ValueError(f"Invalid TLD: {tld!r}")
+        return normalized
 
 class DomainSuggestion(BaseModel):
     name: str = Field(..., description="Suggested domain name")
     available: Optional[bool] = Field(None, description="Domain availability status")
     tld: str = Field(default="com", description="Top-level domain")
 
+class DomainSuggestionGroup(BaseModel):
+    name: str = Field(..., description="Suggested domain name")
+    domains: List[DomainSuggestion] = Field(..., description="The name under each requested TLD")
+
 class DomainSuggestionsResponse(BaseModel):
     suggestions: List[DomainSuggestion]
+    groups: List[DomainSuggestionGroup] = Field(default_factory=list, description="Suggestions grouped by name")
     industry: str
     keywords: List[str]
     processing_time: float
     source: str = "ai"
+    partial: bool = Field(default=False, description="Some availability checks failed or did not finish in time")
+
+# Per-name availability cache values; "-" marks a recent failed lookup
+AVAILABILITY_VALUES = {True: b"1", False: b"0", None: b"-"}
+AVAILABILITY_DECODE = {value: available for available, value in AVAILABILITY_VALUES.items()}
+
+# WHOIS replies that mean "not registered" (python-whois raises on some of them)
+NOT_FOUND_MARKERS = ("no match for", "not found", "no data found", "no entries found", "status: free")
+
+# A (name, tld) pair, e.g. ("Brandly", "io")
+DomainPair = Tuple[str, str]
+
+def availability_key(domain: str, tld: str) -> str:
+    return f"avail:{tld}:{domain.lower()}"
+
+def availability_ttl(available: Optional[bool]) -> int:
+    if available is None:
+        return settings.availability_ttl_failed
+    return settings.availability_ttl_available if available else settings.availability_ttl_taken
+
+# Cached suggestion lists: a version byte, a flags byte, then a msgpack array
+# of [name, available, tld] rows, zlib-compressed when FLAG_ZLIB is set
+CACHE_CODEC_VERSION = 1
+FLAG_ZLIB = 0x01
+
+def encode_suggestions(suggestions: List[DomainSuggestion]) -> bytes:
+    payload = msgpack.packb([[s.name, s.available, s.tld] for s in suggestions])
+    flags = 0
+    if len(payload) > settings.cache_compress_min_bytes:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+    return bytes((CACHE_CODEC_VERSION, flags)) + payload
+
+def decode_suggestions(data: bytes) -> Optional[List[DomainSuggestion]]:
+    """Decode a cached list; None for values written by another codec version"""
+    if len(data) < 2 or data[0] != CACHE_CODEC_VERSION:
+        return None
+    payload = data[2:]
+    if data[1] & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    # Rows were validated when they were generated; skip re-validation
+    return [
+        DomainSuggestion.model_construct(name=name, available=available, tld=tld)
+        for name, available, tld in msgpack.unpackb(payload)
+    ]
 
 # Services
 class CacheService:
     def __init__(self, redis_url: str):
         self.redis = redis.from_url(redis_url)
 
-    async def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+    async def get(self, key: str) -> Optional[List[DomainSuggestion]]:
+        return (await self.get_many([key]))[0]
+
+    async def set(self, key: str, value: List[DomainSuggestion], ttl: int = 3600):
+        await self.set_many({key: value}, ttl)
+
+    async def get_many(self, keys: List[str]) -> List[Optional[List[DomainSuggestion]]]:
+        """Cached lists for `keys` in order, None for misses, in one round trip"""
+        if not keys:
+            return []
         try:
-            data = await self.redis.get(key)
-            if data:
-                return eval(data.decode())  # Simple JSON-like parsing
-            return None
+            values = await self.redis.mget(keys)
         except Exception as e:
-            logger.error("Cache get error", key=key, error=str(e))
-            return None
+            logger.error("Cache get error", key=keys[0], count=len(keys), error=str(e))
+            return [None] * len(keys)
 
-    async def set(self, key: str, value: List[Dict[str, Any]], ttl: int = 3600):
+        results = []
+        for key, data in zip(keys, values):
+            try:
+                results.append(decode_suggestions(data) if data else None)
+            except Exception as e:
+                logger.error("Cache decode error", key=key, error=str(e))
+                results.append(None)
+        return results
+
+    async def set_many(self, items: Dict[str, List[DomainSuggestion]], ttl: int = 3600):
+        """Store several lists with one pipeline"""
+        if not items:
+            return
         try:
-            await self.redis.setex(key, ttl, str(value))
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key, value in items.items():
+                    pipe.setex(key, ttl, encode_suggestions(value))
+                await pipe.execute()
         except Exception as e:
-            logger.error("Cache set error", key=key, error=str(e))
+            logger.error("Cache set error", key=next(iter(items)), count=len(items), error=str(e))
+
+    async def get_availability(self, pairs: List[DomainPair]) -> Dict[DomainPair, Optional[bool]]:
+        """Cached availability for the pairs that have an entry, in one MGET"""
+        if not pairs:
+            return {}
+        try:
+            values = await self.redis.mget([availability_key(domain, tld) for domain, tld in pairs])
+        except Exception as e:
+            logger.error("Cache get error", key="availability", error=str(e))
+            return {}
+        return {
+            pair: AVAILABILITY_DECODE[value]
+            for pair, value in zip(pairs, values)
+            if value in AVAILABILITY_DECODE
+        }
+
+    async def set_availability(self, results: Dict[DomainPair, Optional[bool]]):
+        """Store lookup results in one pipeline, each with the TTL for its outcome"""
+        if not results:
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for (domain, tld), available in results.items():
+                    pipe.setex(availability_key(domain, tld), availability_ttl(available),
+                               AVAILABILITY_VALUES[available])
+                await pipe.execute()
+        except Exception as e:
+            logger.error("Cache set error", key="availability", error=str(e))
+
+# A complete JSON string literal, e.g. "TechNova"
+JSON_STRING_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"')
 
 class AISuggestionService:
     def __init__(self, api_key: str):
         self.client = AsyncOpenAI(api_key=api_key)
 
-    async def generate_suggestions(
-        self,
-        industry: str,
-        keywords: List[str],
-        limit: int = 10
-    ) -> List[str]:
-        try:
-            keywords_str = ", ".join(keywords) if keywords else "general business"
+    @staticmethod
+    def build_prompt(industry: str, keywords: List[str], limit: int) -> str:
+        keywords_str = ", ".join(keywords) if keywords else "general business"
 
-            prompt = f"""Generate {limit} creative and memorable domain name suggestions for a {industry} business.
+        return f"""Generate {limit} creative and memorable domain name suggestions for a {industry} business.
 Keywords/themes: {keywords_str}
 
 Requirements:
-- Suggest only the domain names without .com extension
+- Suggest only the domain names without any extension (.com, .io, ...)
 - Make them unique, brandable, and easy to remember
 - Avoid hyphens when possible
 - Consider industry relevance
@@ -108,9 +248,38 @@ Requirements:
 
 Example format: ["DomainName1", "DomainName2", "DomainName3"]"""
 
+    @staticmethod
+    def parse_suggestions(content: str, limit: int) -> List[str]:
+        # Parse JSON response
+        try:
+            suggestions = json.loads(content.strip())
+            if isinstance(suggestions, list):
+                return [s.strip() for s in suggestions if s.strip()][:limit]
+        except json.JSONDecodeError:
+            # Fallback: extract from text
+            lines = content.strip().split('\n')
+            suggestions = []
+            for line in lines:
+                line = line.strip()
+                if line and not line.startswith('[') and not line.startswith(']'):
+                    # Remove quotes and commas
+                    clean = line.strip('",[]')
+                    if clean and len(clean) > 2:
+                        suggestions.append(clean)
+            return suggestions[:limit]
+
+        return []
+
+    async def generate_suggestions(
+        self,
+        industry: str,
+        keywords: List[str],
+        limit: int = 10
+    ) -> List[str]:
+        try:
             response = await self.client.chat.completions.create(
                 model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
+                messages=[{"role": "user", "content": self.build_prompt(industry, keywords, limit)}],
                 max_tokens=500,
                 temperature=0.8
             )
@@ -119,108 +288,343 @@ Example format: ["DomainName1", "DomainName2", "DomainName3"]"""
             if not content:
                 return []
 
-            # Parse JSON response
-            try:
-                import json
-                suggestions = json.loads(content.strip())
-                if isinstance(suggestions, list):
-                    return [s.strip() for s in suggestions if s.strip()][:limit]
-            except json.JSONDecodeError:
-                # Fallback: extract from text
-                lines = content.strip().split('\n')
-                suggestions = []
-                for line in lines:
-                    line = line.strip()
-                    if line and not line.startswith('[') and not line.startswith(']'):
-                        # Remove quotes and commas
-                        clean = line.strip('",[]')
-                        if clean and len(clean) > 2:
-                            suggestions.append(clean)
-                return suggestions[:limit]
+            return self.parse_suggestions(content, limit)
 
+        except Exception as e:
+            logger.error("AI suggestion error", industry=industry, error=str(e))
             return []
 
+    async def stream_suggestions(
+        self,
+        industry: str,
+        keywords: List[str],
+        limit: int = 10
+    ) -> AsyncIterator[str]:
+        """Yield names as soon as each string in the model's JSON array is complete"""
+        content = ""
+        matched = 0
+        names: List[str] = []
+        try:
+            stream = await self.client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[{"role": "user", "content": self.build_prompt(industry, keywords, limit)}],
+                max_tokens=500,
+                temperature=0.8,
+                stream=True
+            )
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                content += chunk.choices[0].delta.content or ""
+                literals = JSON_STRING_PATTERN.findall(content)
+                for literal in literals[matched:]:
+                    name = json.loads(f'"{literal}"').strip()
+                    if name and len(names) < limit:
+                        names.append(name)
+                        yield name
+                matched = len(literals)
         except Exception as e:
             logger.error("AI suggestion error", industry=industry, error=str(e))
-            return []
+            return
+
+        # The model ignored the JSON format; fall back to the batch parser
+        if not names and content:
+            for name in self.parse_suggestions(content, limit):
+                yield name
 
 class DomainAvailabilityService:
-    async def check_availability(self, domain: str, tld: str = "com") -> bool:
-        """Check if a domain is available using WHOIS"""
+    def __init__(self, concurrency: int, timeout: float, cache: Optional[CacheService] = None,
+                 registered: Optional[RegisteredNameFilter] = None):
+        self.timeout = timeout
+        self.cache = cache
+        self.registered = registered
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # python-whois blocks and has no timeout of its own, so lookups run on
+        # threads; spare threads absorb lookups that outlive their timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency * 2, thread_name_prefix="whois")
+
+    async def check_availability(self, domain: str, tld: str = "com") -> Optional[bool]:
+        """Check if a domain is available using WHOIS; None if the lookup failed"""
+        full_domain = f"{domain}.{tld}"
         try:
-            full_domain = f"{domain}.{tld}"
-            w = whois.whois(full_domain)
+            async with self.semaphore:
+                loop = asyncio.get_running_loop()
+                w = await asyncio.wait_for(
+                    loop.run_in_executor(self.executor, whois.whois, full_domain),
+                    timeout=self.timeout
+                )
 
             # If domain_name is None or empty, domain is likely available
             return not w.domain_name or len(str(w.domain_name)) == 0
 
+        except asyncio.TimeoutError:
+            logger.warning("WHOIS check timed out", domain=domain, tld=tld, timeout=self.timeout)
+            return None
         except Exception as e:
+            # python-whois raises on "No match for ..." replies for unregistered names
+            if any(marker in str(e).lower() for marker in NOT_FOUND_MARKERS):
+                return True
+            # Anything else is unknown, not available
             logger.warning("WHOIS check failed", domain=domain, tld=tld, error=str(e))
-            # If WHOIS fails, assume available (better UX)
-            return True
+            return None
+
+    async def check_many(self, pairs: List[DomainPair],
+                         deadline: Optional[float] = None) -> Dict[DomainPair, Optional[bool]]:
+        """
+        Check several (name, tld) pairs concurrently, answering from the
+        availability cache first and caching fresh WHOIS results. Names the
+        registered-name filter knows are reported taken without a lookup.
+        Lookups still running at `deadline` (a time.monotonic() value) are
+        cancelled and reported as None.
+        """
+        return {pair: available async for pair, available in self.iter_availability(pairs, deadline)}
+
+    async def iter_availability(self, pairs: List[DomainPair],
+                                deadline: Optional[float] = None) -> AsyncIterator[Tuple[DomainPair, Optional[bool]]]:
+        """check_many, yielding each result as soon as it is known"""
+        pairs = list(dict.fromkeys(pairs))
+        results = await self.cache.get_availability(pairs) if self.cache else {}
+        if self.registered:
+            # Not cached: the filter is cheaper than Redis and a new build
+            # should take effect immediately
+            skipped = [
+                (domain, tld) for domain, tld in pairs
+                if (domain, tld) not in results and self.registered.might_be_registered(f"{domain}.{tld}")
+            ]
+            results.update((pair, False) for pair in skipped)
+            if skipped:
+                logger.info("WHOIS skipped by registered-name filter", count=len(skipped))
+        for pair, available in results.items():
+            yield pair, available
+
+        tasks = {
+            asyncio.create_task(self.check_availability(domain, tld)): (domain, tld)
+            for domain, tld in pairs if (domain, tld) not in results
+        }
+        fresh: Dict[DomainPair, Optional[bool]] = {}
+        pending = set(tasks)
+        try:
+            while pending:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    fresh[tasks[task]] = task.result()
+                    yield tasks[task], fresh[tasks[task]]
+        finally:
+            # Also reached when the consumer stops early, e.g. a client disconnect
+            for task in pending:
+                task.cancel()
+
+        if pending:
+            logger.warning("Availability deadline reached", unresolved=len(pending), total=len(tasks))
+        # Abandoned lookups are not cached; they may well succeed next time
+        if self.cache:
+            await self.cache.set_availability(fresh)
+        for task in pending:
+            yield tasks[task], None
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
 class DomainSuggestionService:
     def __init__(self):
         self.cache = CacheService(settings.redis_url)
         self.ai = AISuggestionService(settings.openai_api_key) if settings.openai_api_key else None
-        self.availability = DomainAvailabilityService()
+        self.local = NameGenerator()
+        self.registered = RegisteredNameFilter(
+            settings.registered_filter_path, settings.registered_filter_check_interval
+        )
+        self.availability = DomainAvailabilityService(
+            settings.whois_concurrency, settings.whois_timeout, self.cache, self.registered
+        )
+
+    def resolve_engine(self, request: DomainSuggestionRequest) -> str:
+        """The engine to use: auto only when the AI is configured, local otherwise"""
+        engine = request.engine or settings.suggestion_engine
+        if engine == "auto" and not self.ai:
+            return "local"
+        if engine == "ai" and not self.ai:
+            raise HTTPException(status_code=503, detail="AI service unavailable")
+        return engine
+
+    def local_names(self, request: DomainSuggestionRequest, count: int, exclude: List[str]) -> List[str]:
+        return self.local.generate(request.industry, request.keywords, count, exclude=exclude)
 
     async def suggest_domains(self, request: DomainSuggestionRequest) -> DomainSuggestionsResponse:
-        import time
         start_time = time.time()
+        engine = self.resolve_engine(request)
 
         # Create cache key
         cache_key = f"domains:{request.industry}:{','.join(sorted(request.keywords))}:{request.limit}"
 
-        # Check cache
-        cached = await self.cache.get(cache_key)
+        # Check cache; it holds AI-generated names; availability is re-read
+        # from the per-name cache so each name keeps its own TTL. Local names
+        # are cheaper to regenerate than to fetch.
+        cached = await self.cache.get(cache_key) if engine != "local" else None
         if cached:
-            return DomainSuggestionsResponse(
-                suggestions=[DomainSuggestion(**s) for s in cached],
-                industry=request.industry,
-                keywords=request.keywords,
-                processing_time=time.time() - start_time,
-                source="cache"
+            domain_names = [s.name for s in cached]
+            source = "cache"
+        else:
+            domain_names = []
+            if engine != "local":
+                try:
+                    domain_names = await asyncio.wait_for(
+                        self.ai.generate_suggestions(request.industry, request.keywords, request.limit),
+                        settings.ai_timeout if engine == "auto" else None
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning("AI suggestions timed out", timeout=settings.ai_timeout)
+            source = "ai"
+
+            # Fill in whatever the AI did not deliver
+            if engine != "ai" and len(domain_names) < request.limit:
+                source = "ai+local" if domain_names else "local"
+                domain_names += self.local_names(request, request.limit - len(domain_names), domain_names)
+
+            if not domain_names:
+                raise HTTPException(status_code=500, detail="Failed to generate suggestions")
+
+            # Only complete AI answers are cached; filled-in ones get another
+            # chance at the AI next time
+            if source == "ai":
+                await self.cache.set(cache_key, [DomainSuggestion(name=name) for name in domain_names])
+
+        # Check every name under every TLD in one concurrent pass, returning
+        # whatever resolved by the deadline
+        pairs = [(name, tld) for name in domain_names for tld in request.tlds]
+        availability: Dict[DomainPair, Optional[bool]] = {}
+        if request.check_availability:
+            availability = await self.availability.check_many(
+                pairs,
+                deadline=time.monotonic() + settings.availability_deadline
             )
+        partial = any(availability.get(pair) is None for pair in pairs) if availability else False
 
-        # Generate suggestions
-        if not self.ai:
-            raise HTTPException(status_code=503, detail="AI service unavailable")
-
-        domain_names = await self.ai.generate_suggestions(
-            request.industry,
-            request.keywords,
-            request.limit
-        )
-
-        if not domain_names:
-            raise HTTPException(status_code=500, detail="Failed to generate suggestions")
-
-        # Check availability if requested
-        suggestions = []
-        for name in domain_names:
-            available = None
-            if request.check_availability:
-                available = await self.availability.check_availability(name)
-
-            suggestions.append(DomainSuggestion(
+        groups = [
+            DomainSuggestionGroup(
                 name=name,
-                available=available,
-                tld="com"
-            ))
-
-        # Cache results
-        cache_data = [s.dict() for s in suggestions]
-        await self.cache.set(cache_key, cache_data)
+                domains=[
+                    DomainSuggestion(name=name, available=availability.get((name, tld)), tld=tld)
+                    for tld in request.tlds
+                ]
+            )
+            for name in domain_names
+        ]
 
         return DomainSuggestionsResponse(
-            suggestions=suggestions,
+            suggestions=[suggestion for group in groups for suggestion in group.domains],
+            groups=groups,
             industry=request.industry,
             keywords=request.keywords,
             processing_time=time.time() - start_time,
-            source="ai"
+            source=source,
+            partial=partial
         )
 
+    async def stream_suggestions(self, request: DomainSuggestionRequest) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Yield (event, data) pairs: a "suggestion" for each name x TLD as soon as
+        the name is generated, an "availability" update as each check resolves,
+        and a closing "summary". Each name's checks start when it arrives and
+        get their own availability_deadline.
+        """
+        start_time = time.time()
+        engine = self.resolve_engine(request)
+        cache_key = f"domains:{request.industry}:{','.join(sorted(request.keywords))}:{request.limit}"
+
+        cached = await self.cache.get(cache_key) if engine != "local" else None
+
+        # Names and availability results are produced concurrently and merged
+        # through one queue; each producer ends with a None sentinel
+        events: asyncio.Queue = asyncio.Queue()
+        checks: List[asyncio.Task] = []
+        names: List[str] = []
+        sources: Set[str] = set()
+        producers = 1
+        unknown = 0
+
+        async def check(name: str):
+            try:
+                pairs = [(name, tld) for tld in request.tlds]
+                deadline = time.monotonic() + settings.availability_deadline
+                async for (domain, tld), available in self.availability.iter_availability(pairs, deadline):
+                    events.put_nowait(("availability", DomainSuggestion(name=domain, available=available, tld=tld)))
+            finally:
+                events.put_nowait(None)
+
+        def emit(name: str, source: str):
+            nonlocal producers
+            sources.add(source)
+            names.append(name)
+            for tld in request.tlds:
+                events.put_nowait(("suggestion", DomainSuggestion(name=name, tld=tld)))
+            if request.check_availability:
+                producers += 1
+                checks.append(asyncio.create_task(check(name)))
+
+        async def generate():
+            try:
+                if cached:
+                    for suggestion in cached:
+                        emit(suggestion.name, "cache")
+                    return
+                if engine != "local":
+                    await stream_ai()
+                if engine != "ai" and len(names) < request.limit:
+                    for name in self.local_names(request, request.limit - len(names), names):
+                        emit(name, "local")
+            finally:
+                events.put_nowait(None)
+
+        async def stream_ai():
+            stream = self.ai.stream_suggestions(request.industry, request.keywords, request.limit)
+            deadline = time.monotonic() + settings.ai_timeout if engine == "auto" else None
+            try:
+                while True:
+                    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                    emit(await asyncio.wait_for(anext(stream), timeout), "ai")
+            except StopAsyncIteration:
+                pass
+            except asyncio.TimeoutError:
+                logger.warning("AI suggestions timed out", timeout=settings.ai_timeout)
+            finally:
+                await stream.aclose()
+
+        generator = asyncio.create_task(generate())
+        try:
+            while producers:
+                item = await events.get()
+                if item is None:
+                    producers -= 1
+                    continue
+                event, suggestion = item
+                if event == "availability" and suggestion.available is None:
+                    unknown += 1
+                yield event, suggestion.dict()
+        finally:
+            # Stops WHOIS work when the client goes away mid-stream
+            generator.cancel()
+            for task in checks:
+                task.cancel()
+
+        if not names:
+            yield "error", {"detail": "Failed to generate suggestions"}
+            return
+        if sources == {"ai"}:
+            await self.cache.set(cache_key, [DomainSuggestion(name=name) for name in names])
+
+        yield "summary", {
+            "count": len(names),
+            "industry": request.industry,
+            "keywords": request.keywords,
+            "tlds": request.tlds,
+            "processing_time": time.time() - start_time,
+            "source": "+".join(sorted(sources)),
+            "partial": unknown > 0
+        }
+
 # FastAPI app
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -229,6 +633,8 @@ async def lifespan(app: FastAPI):
     yield
     # Shutdown
     logger.info("Shutting down Domain Suggestions service")
+    suggestion_service.availability.close()
+    suggestion_service.registered.close()
 
 app = FastAPI(
     title="Domain Suggestions API",
@@ -246,82 +652,197 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Rate limiting (simple in-memory implementation)
-request_counts: Dict[str, List[float]] = {}
-
-def check_rate_limit(client_ip: str) -> bool:
-    import time
-    now = time.time()
-    window_start = now - settings.rate_limit_window
-
-    if client_ip not in request_counts:
-        request_counts[client_ip] = []
-
-    # Remove old requests
-    request_counts[client_ip] = [
-        t for t in request_counts[client_ip] if t > window_start
-    ]
-
-    if len(request_counts[client_ip]) >= settings.rate_limit_requests:
-        return False
+# Rate limiting: GCRA (generic cell rate algorithm). Each client has a
+# theoretical arrival time (TAT) that advances by `interval` per request; a
+# request is allowed while the TAT is at most `window` ahead of now, which
+# permits `limit` requests in a burst and then one per `interval`.
+GCRA_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+tat = math.max(tat, now) + interval
+local wait = tat - window - now
+if wait > 0 then
+    return {0, wait}
+end
+redis.call('SET', KEYS[1], tat, 'PX', tat - now)
+return {1, 0}
+"""
+
+class LocalRateLimiter:
+    """In-process GCRA over a bounded LRU of clients; used while Redis is down"""
+
+    def __init__(self, limit: int, window: int, max_clients: int):
+        self.interval = window / limit
+        self.window = window
+        self.max_clients = max_clients
+        self.tats: "OrderedDict[str, float]" = OrderedDict()
+
+    def check(self, client: str) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tat = max(self.tats.get(client, now), now) + self.interval
+        wait = tat - self.window - now
+        if wait > 0:
+            return False, wait
+        self.tats[client] = tat
+        self.tats.move_to_end(client)
+        if len(self.tats) > self.max_clients:
+            # The least recently seen client is the one closest to a clean slate
+            self.tats.popitem(last=False)
+        return True, 0.0
+
+class RateLimiter:
+    """Per-client limit shared by all workers through one atomic Redis script"""
+
+    RETRY_INTERVAL = 5.0
+
+    def __init__(self, redis_client, limit: int, window: int, local_clients: int):
+        self.interval_ms = window * 1000 // limit
+        self.window_ms = window * 1000
+        self.script = redis_client.register_script(GCRA_SCRIPT)
+        self.local = LocalRateLimiter(limit, window, local_clients)
+        self.degraded = False
+        self.retry_at = 0.0
+
+    async def check(self, client: str) -> Tuple[bool, float]:
+        """(allowed, seconds until the next request would be allowed)"""
+        # While Redis is down, only probe it every RETRY_INTERVAL seconds
+        if self.degraded and time.monotonic() < self.retry_at:
+            return self.local.check(client)
+        try:
+            allowed, wait_ms = await self.script(
+                keys=[f"ratelimit:{client}"], args=[self.interval_ms, self.window_ms]
+            )
+        except Exception as e:
+            if not self.degraded:
+                logger.warning("Rate limiter falling back to local counts", error=str(e))
+                self.degraded = True
+            self.retry_at = time.monotonic() + self.RETRY_INTERVAL
+            return self.local.check(client)
 
-    request_counts[client_ip].append(now)
-    return True
+        if self.degraded:
+            logger.info("Rate limiter using Redis again")
+            self.degraded = False
+        return bool(allowed), wait_ms / 1000
 
 # Dependency injection
 suggestion_service = DomainSuggestionService()
+rate_limiter = RateLimiter(
+    suggestion_service.cache.redis,
+    settings.rate_limit_requests,
+    settings.rate_limit_window,
+    settings.rate_limit_local_clients
+)
+
+async def enforce_rate_limit(http_request: Request):
+    # The caller's address once uvicorn has applied a trusted proxy's X-Forwarded-For
+    client = http_request.client.host if http_request.client else "unknown"
+    allowed, retry_after = await rate_limiter.check(client)
+    if not allowed:
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(max(1, round(retry_after)))}
+        )
 
 # Routes
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "domain-suggestions"}
-
-@app.post("/api/suggest", response_model=DomainSuggestionsResponse)
-async def suggest_domains(
-    request: DomainSuggestionRequest,
-    client_ip: str = "unknown"
-):
-    # Rate limiting
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
-
+    return {
+        "status": "healthy",
+        "service": "domain-suggestions",
+        "registered_filter": suggestion_service.registered.stats()
+    }
+
+@app.post("/api/suggest", response_model=DomainSuggestionsResponse,
+          dependencies=[Depends(enforce_rate_limit)])
+async def suggest_domains(request: DomainSuggestionRequest):
     try:
         return await suggestion_service.suggest_domains(request)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error("API error", error=str(e), request=request.dict())
         raise HTTPException(status_code=500, detail="Internal server error")
 
-@app.get("/api/suggest")
-async def suggest_domains_get(
+def query_suggestion_request(
     industry: str = Query(..., description="Business industry/sector"),
     keywords: List[str] = Query(default_factory=list, description="Keywords describing the business"),
     limit: int = Query(default=10, ge=1, le=20, description="Number of suggestions"),
     check_availability: bool = Query(default=True, description="Check domain availability"),
-    client_ip: str = "unknown"
-):
-    # Rate limiting
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
-
-    request = DomainSuggestionRequest(
-        industry=industry,
-        keywords=keywords,
-        limit=limit,
-        check_availability=check_availability
-    )
+    tlds: List[str] = Query(default=["com"], description="Top-level domains to check"),
+    engine: Optional[Literal["auto", "local", "ai"]] = Query(default=None, description="Name generator")
+) -> DomainSuggestionRequest:
+    try:
+        return DomainSuggestionRequest(
+            industry=industry,
+            keywords=keywords,
+            limit=limit,
+            check_availability=check_availability,
+            tlds=tlds,
+            engine=engine
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
 
+@app.get("/api/suggest", dependencies=[Depends(enforce_rate_limit)])
+async def suggest_domains_get(
+    request: DomainSuggestionRequest = Depends(query_suggestion_request)
+):
     try:
         return await suggestion_service.suggest_domains(request)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error("API error", error=str(e), request=request.dict())
         raise HTTPException(status_code=500, detail="Internal server error")
 
+def format_event(event: str, data: Dict[str, Any], sse: bool) -> str:
+    if sse:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({"event": event, "data": data}) + "\n"
+
+async def stream_suggestions_response(request: DomainSuggestionRequest, http_request: Request) -> StreamingResponse:
+    """NDJSON by default, Server-Sent Events when the client accepts text/event-stream"""
+    sse = "text/event-stream" in http_request.headers.get("accept", "")
+    events = suggestion_service.stream_suggestions(request)
+    # Pull the first event before responding so setup errors still get a status code
+    first = await anext(events)
+
+    async def body():
+        try:
+            yield format_event(*first, sse)
+            async for event, data in events:
+                yield format_event(event, data, sse)
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/suggest/stream", dependencies=[Depends(enforce_rate_limit)])
+async def suggest_domains_stream(request: DomainSuggestionRequest, http_request: Request):
+    return await stream_suggestions_response(request, http_request)
+
+@app.get("/api/suggest/stream", dependencies=[Depends(enforce_rate_limit)])
+async def suggest_domains_stream_get(
+    http_request: Request,
+    request: DomainSuggestionRequest = Depends(query_suggestion_request)
+):
+    return await stream_suggestions_response(request, http_request)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=settings.port,
-        reload=True,
+        proxy_headers=True,
+        forwarded_allow_ips=settings.forwarded_allow_ips,
         log_level="info"
     )
\ No newline at end of file
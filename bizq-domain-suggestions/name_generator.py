@@ -0,0 +1,213 @@
+"""
+Local domain name generator
+
+Builds brandable candidates from an industry and keywords without calling a
+model: compounds of two roots, blends that overlap or splice them, and
+prefixed/suffixed forms, seeded from the keywords and an industry lexicon.
+A cheap scorer ranks the candidates on length, pronounceability and relevance.
+Output is deterministic for the same input.
+
+    python name_generator.py technology cloud fast
+"""
+
+import re
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+# Root words per industry; an industry string selects every entry whose key or
+# aliases it mentions
+INDUSTRY_LEXICON: Dict[str, Tuple[str, ...]] = {
+    "tech": ("byte", "code", "data", "cloud", "stack", "pixel", "logic", "sync", "node", "core", "bit", "flow"),
+    "food": ("fork", "plate", "spice", "taste", "feast", "bite", "grill", "oven", "bowl", "crumb", "menu", "fresh"),
+    "health": ("care", "vital", "well", "pulse", "heal", "cure", "med", "life", "zen", "calm", "thrive", "vita"),
+    "finance": ("coin", "fund", "vault", "ledger", "cash", "wealth", "capital", "mint", "yield", "pay", "bank", "trust"),
+    "retail": ("shop", "cart", "store", "deal", "market", "mart", "goods", "shelf", "bazaar", "basket", "trade", "buy"),
+    "education": ("learn", "tutor", "study", "mentor", "class", "skill", "school", "mind", "sage", "quest", "lesson", "brain"),
+    "travel": ("trip", "voyage", "trek", "roam", "journey", "atlas", "wander", "route", "jet", "globe", "nomad", "tour"),
+    "realestate": ("home", "nest", "estate", "haven", "dwell", "key", "property", "roof", "abode", "land", "door", "realty"),
+    "fitness": ("fit", "lift", "sweat", "strong", "pace", "gym", "core", "stride", "flex", "burn", "move", "peak"),
+    "beauty": ("glow", "glam", "luxe", "bloom", "silk", "polish", "radiant", "pure", "muse", "velvet", "aura", "blush"),
+    "legal": ("law", "counsel", "brief", "justice", "case", "verdict", "legal", "advocate", "clause", "accord", "right", "fair"),
+    "marketing": ("buzz", "brand", "reach", "spark", "pitch", "amplify", "signal", "boost", "echo", "launch", "story", "ad"),
+    "construction": ("build", "forge", "beam", "brick", "frame", "craft", "stone", "solid", "steel", "crew", "level", "maker"),
+    "automotive": ("drive", "motor", "gear", "auto", "wheel", "torque", "rev", "road", "car", "turbo", "garage", "ride"),
+    "pets": ("paw", "pet", "woof", "tail", "purr", "fetch", "whisker", "pup", "kitty", "bark", "furry", "buddy"),
+    "creative": ("studio", "canvas", "muse", "ink", "design", "palette", "frame", "craft", "vision", "art", "sketch", "hue"),
+}
+
+INDUSTRY_ALIASES: Dict[str, Tuple[str, ...]] = {
+    "tech": ("technology", "software", "saas", "it", "ai", "app", "digital", "startup", "web", "computer"),
+    "food": ("restaurant", "cafe", "coffee", "bakery", "catering", "kitchen", "bar", "pizza", "dining"),
+    "health": ("healthcare", "medical", "clinic", "wellness", "dental", "pharmacy", "therapy", "hospital"),
+    "finance": ("fintech", "banking", "accounting", "insurance", "investment", "crypto", "payments", "lending"),
+    "retail": ("ecommerce", "commerce", "shop", "store", "fashion", "apparel", "boutique"),
+    "education": ("edtech", "school", "learning", "training", "tutoring", "academy", "course"),
+    "travel": ("tourism", "hospitality", "hotel", "airline", "vacation", "booking"),
+    "realestate": ("real estate", "property", "housing", "rental", "mortgage", "realty"),
+    "fitness": ("gym", "sports", "yoga", "training", "athletic"),
+    "beauty": ("cosmetics", "salon", "spa", "skincare", "makeup", "hair"),
+    "legal": ("law", "attorney", "lawyer", "compliance"),
+    "marketing": ("advertising", "agency", "media", "pr", "seo", "social"),
+    "construction": ("contractor", "building", "renovation", "plumbing", "roofing", "engineering", "manufacturing"),
+    "automotive": ("auto", "car", "cars", "vehicle", "mechanic", "dealership", "transport", "logistics"),
+    "pets": ("pet", "veterinary", "vet", "dog", "cat", "grooming"),
+    "creative": ("design", "photography", "art", "music", "film", "studio", "branding"),
+}
+
+# Neutral roots that pair well with anything
+GENERIC_ROOTS = ("nova", "bright", "true", "prime", "swift", "bold", "peak", "spark", "blue", "clear")
+
+PREFIXES = ("get", "try", "go", "my", "hey", "join", "the", "use")
+SUFFIXES = ("ly", "ify", "hub", "lab", "labs", "hq", "co", "base", "works", "wise", "nest", "spot", "able", "io")
+
+VOWELS = frozenset("aeiouy")
+CONSONANT_RUN = re.compile(r"[^aeiouy]{4,}")
+REPEATED_LETTER = re.compile(r"(.)\1\1")
+
+MIN_LENGTH = 4
+MAX_LENGTH = 15
+IDEAL_LENGTH = (6, 10)
+
+
+def normalize_word(word: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", word.lower())
+
+
+def lexicon_for(industry: str) -> List[str]:
+    """Lexicon roots for every sector the industry string mentions"""
+    text = f" {industry.lower()} "
+    tokens = set(re.findall(r"[a-z]+", text))
+    roots: List[str] = []
+    for sector, words in INDUSTRY_LEXICON.items():
+        aliases = INDUSTRY_ALIASES.get(sector, ())
+        if sector in tokens or any(alias in tokens or (" " in alias and alias in text) for alias in aliases):
+            roots.extend(words)
+    return list(dict.fromkeys(roots))
+
+
+def blend(a: str, b: str) -> Iterator[str]:
+    """Portmanteaus of a and b: overlapping ends, then vowel-anchored splices"""
+    for k in range(min(len(a), len(b)) - 1, 1, -1):
+        if a.endswith(b[:k]):
+            yield a + b[k:]
+            break
+    # Keep a through its last vowel, continue b from its first vowel
+    last_vowel = max((i for i, c in enumerate(a) if c in VOWELS), default=-1)
+    first_vowel = next((i for i, c in enumerate(b) if c in VOWELS), -1)
+    if 1 < last_vowel < len(a) - 1 and first_vowel > 0:
+        yield a[:last_vowel + 1] + b[first_vowel + 1:]
+
+
+def add_suffix(root: str, suffix: str) -> str:
+    if suffix == "ify" and root[-1] in "ey":
+        return root[:-1] + suffix
+    if suffix == "able" and root[-1] == "e":
+        return root[:-1] + suffix
+    return root + suffix
+
+
+def score(name: str, keywords: Set[str], lexicon: Set[str]) -> float:
+    """Higher is better; -inf for names that should never be shown"""
+    length = len(name)
+    if not MIN_LENGTH <= length <= MAX_LENGTH:
+        return float("-inf")
+    if CONSONANT_RUN.search(name) or REPEATED_LETTER.search(name):
+        return float("-inf")
+
+    value = 10.0
+    low, high = IDEAL_LENGTH
+    value -= max(0, low - length) * 1.5 + max(0, length - high) * 1.0
+
+    vowel_ratio = sum(c in VOWELS for c in name) / length
+    value -= abs(vowel_ratio - 0.4) * 8
+
+    matched_keywords = sum(1 for keyword in keywords if keyword in name)
+    value += 3.0 * min(matched_keywords, 2)
+    if any(root in name for root in lexicon):
+        value += 1.5
+    return value
+
+
+class NameGenerator:
+    def __init__(self, max_per_root: int = 2):
+        # How many of the returned names may share a root or affix, for variety
+        self.max_per_root = max_per_root
+
+    def seeds(self, industry: str, keywords: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """(keyword roots, lexicon roots) used to build candidates"""
+        # Multi-word keywords contribute each word, like the industry string
+        keyword_roots = [normalize_word(w) for k in keywords for w in re.findall(r"[A-Za-z]+", k)]
+        keyword_roots += [normalize_word(w) for w in re.findall(r"[A-Za-z]+", industry) if len(w) > 3]
+        keyword_roots = [root for root in dict.fromkeys(keyword_roots) if 2 < len(root) <= 10]
+        lexicon_roots = [root for root in lexicon_for(industry) if root not in keyword_roots]
+        if len(lexicon_roots) < 6:
+            lexicon_roots += [root for root in GENERIC_ROOTS if root not in keyword_roots]
+        return keyword_roots, lexicon_roots
+
+    def candidates(self, keyword_roots: List[str], lexicon_roots: List[str]) -> Iterator[Tuple[str, Tuple[str, ...]]]:
+        """(name, roots and affixes used) pairs, duplicates included"""
+        roots = keyword_roots + lexicon_roots
+        for root in roots:
+            for suffix in SUFFIXES:
+                yield add_suffix(root, suffix), (root, f"-{suffix}")
+            for prefix in PREFIXES:
+                yield prefix + root, (f"{prefix}-", root)
+        # With two or more keywords, pairs without any keyword are not worth scoring
+        for a in roots:
+            for b in roots:
+                if a == b or (len(keyword_roots) > 1 and a not in keyword_roots and b not in keyword_roots):
+                    continue
+                yield a + b, (a, b)
+                for blended in blend(a, b):
+                    yield blended, (a, b)
+
+    def generate(self, industry: str, keywords: List[str], limit: int = 10,
+                 exclude: Iterable[str] = ()) -> List[str]:
+        """The `limit` best candidates, capitalized, skipping names in `exclude`"""
+        keyword_roots, lexicon_roots = self.seeds(industry, keywords)
+        keyword_set = set(keyword_roots)
+        lexicon_set = set(lexicon_roots)
+        seen = {name.lower() for name in exclude}
+
+        scored: List[Tuple[float, str, Tuple[str, ...]]] = []
+        for name, roots in self.candidates(keyword_roots, lexicon_roots):
+            if name in seen:
+                continue
+            seen.add(name)
+            value = score(name, keyword_set, lexicon_set)
+            if value != float("-inf"):
+                scored.append((-value, name, roots))
+        scored.sort()
+
+        names: List[str] = []
+        per_root: Dict[str, int] = {}
+        for _, name, roots in scored:
+            if any(per_root.get(root, 0) >= self.max_per_root for root in roots):
+                continue
+            for root in roots:
+                per_root[root] = per_root.get(root, 0) + 1
+            names.append(name.capitalize())
+            if len(names) >= limit:
+                break
+        return names
+
+
+def main(argv: List[str]) -> int:
+    if not argv:
+        print("usage: python name_generator.py INDUSTRY [KEYWORD ...]", file=sys.stderr)
+        return 2
+    industry, keywords = argv[0], argv[1:]
+    generator = NameGenerator()
+    started = time.perf_counter()
+    count = sum(1 for _ in generator.candidates(*generator.seeds(industry, keywords)))
+    names = generator.generate(industry, keywords, limit=20)
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f"{count} candidates in {elapsed:.1f} ms")
+    for name in names:
+        print(f"  {name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
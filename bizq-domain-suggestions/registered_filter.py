@@ -0,0 +1,246 @@
+"""
+Registered-name filter
+
+A Bloom filter over registered domain names, built offline from a zone file or
+a plain list of names and memory-mapped by the service. A "no" from the filter
+is certain, a "yes" is right except for the configured false-positive rate, so
+names it reports as registered can skip WHOIS while the rest still get the
+authoritative check.
+
+Build or refresh a filter (the output is swapped in atomically):
+
+    python registered_filter.py build -o registered.bloom com.zone
+    python registered_filter.py build -o registered.bloom --fp-rate 0.001 names.txt
+    python registered_filter.py check registered.bloom example.com
+
+File layout: a fixed header (magic, bit count, hash count, name count)
+followed by the bit array.
+"""
+
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import structlog
+
+logger = structlog.get_logger()
+
+MAGIC = b"BQBLOOM1"
+HEADER = struct.Struct("<8sQIQ")  # magic, num_bits, num_hashes, num_names
+
+
+def normalize(domain: str) -> str:
+    return domain.strip().rstrip(".").lower()
+
+
+def bit_positions(domain: str, num_bits: int, num_hashes: int) -> Iterator[int]:
+    """Double hashing (Kirsch-Mitzenmacher) over one 128-bit digest"""
+    digest = hashlib.blake2b(normalize(domain).encode(), digest_size=16).digest()
+    h1, h2 = struct.unpack("<QQ", digest)
+    h2 |= 1  # odd stride, so positions don't collapse when num_bits is even
+    for i in range(num_hashes):
+        yield (h1 + i * h2) % num_bits
+
+
+def filter_size(expected: int, fp_rate: float) -> Tuple[int, int]:
+    """Bit and hash counts for `expected` names at false-positive rate `fp_rate`"""
+    expected = max(expected, 1)
+    num_bits = math.ceil(-expected * math.log(fp_rate) / (math.log(2) ** 2))
+    num_bits = (num_bits + 7) // 8 * 8
+    num_hashes = max(1, round(num_bits / expected * math.log(2)))
+    return num_bits, num_hashes
+
+
+def read_names(paths: List[str], tld: Optional[str] = None) -> Iterator[str]:
+    """
+    Domain names from zone files or name lists, one record per line.
+
+    Zone records use their owner name (first field); comments, directives and
+    repeated owners are skipped. Bare labels get `.tld` appended when given.
+    """
+    for path in paths:
+        previous = None
+        with (sys.stdin if path == "-" else open(path, encoding="utf-8", errors="replace")) as lines:
+            for line in lines:
+                if not line.strip() or line[0] in ";$" or line[0].isspace():
+                    continue
+                name = normalize(line.split()[0])
+                if name == previous:
+                    continue
+                previous = name
+                if "." not in name:
+                    if not tld:
+                        continue
+                    name = f"{name}.{tld}"
+                yield name
+
+
+def build(names: Iterable[str], output: str, expected: int, fp_rate: float) -> int:
+    """Write a filter for `names` to `output` via a temp file and os.replace"""
+    num_bits, num_hashes = filter_size(expected, fp_rate)
+    bits = bytearray(num_bits // 8)
+    count = 0
+    for name in names:
+        for position in bit_positions(name, num_bits, num_hashes):
+            bits[position >> 3] |= 1 << (position & 7)
+        count += 1
+
+    directory = os.path.dirname(os.path.abspath(output))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".registered-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, num_bits, num_hashes, count))
+            f.write(bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        # Readers keep their old mapping until they notice the new inode
+        os.replace(tmp_path, output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return count
+
+
+class RegisteredNameFilter:
+    """
+    Read-only view of a filter file. The file is mapped, not read, so startup
+    costs no copy and workers share the page cache; `refresh()` picks up a
+    file swapped in by `build`.
+    """
+
+    def __init__(self, path: str, check_interval: float = 30.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._mmap: Optional[mmap.mmap] = None
+        self._stat: Optional[Tuple[int, int, int]] = None
+        self._checked_at = 0.0
+        self.num_bits = 0
+        self.num_hashes = 0
+        self.num_names = 0
+        self.load()
+
+    @property
+    def loaded(self) -> bool:
+        return self._mmap is not None
+
+    def load(self) -> bool:
+        """(Re)map the file; on failure keep serving the previous mapping"""
+        self._checked_at = time.monotonic()
+        try:
+            with open(self.path, "rb") as f:
+                st = os.fstat(f.fileno())
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            if self._mmap is None:
+                logger.warning("Registered-name filter unavailable", path=self.path, error=str(e))
+            return False
+
+        if len(mapped) >= HEADER.size:
+            magic, num_bits, num_hashes, num_names = HEADER.unpack_from(mapped)
+        else:
+            magic, num_bits, num_hashes, num_names = b"", 0, 0, 0  # truncated
+        if (magic != MAGIC or num_bits == 0 or num_hashes == 0
+                or len(mapped) < HEADER.size + num_bits // 8):
+            mapped.close()
+            logger.error("Registered-name filter is malformed", path=self.path)
+            return False
+
+        previous = self._mmap
+        self._mmap = mapped
+        self._stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.num_bits, self.num_hashes, self.num_names = num_bits, num_hashes, num_names
+        if previous is not None:
+            previous.close()
+        logger.info("Registered-name filter loaded", path=self.path, names=num_names,
+                    size_bytes=len(mapped))
+        return True
+
+    def refresh(self):
+        """Remap if the file changed since the last check, at most every check_interval"""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        if (st.st_ino, st.st_size, st.st_mtime_ns) != self._stat:
+            self.load()
+
+    def might_be_registered(self, domain: str) -> bool:
+        """False means certainly not in the source data; True may be a false positive"""
+        self.refresh()
+        if self._mmap is None:
+            return False
+        data = self._mmap
+        for position in bit_positions(domain, self.num_bits, self.num_hashes):
+            if not data[HEADER.size + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "path": self.path,
+            "names": self.num_names,
+            "bits": self.num_bits,
+            "hashes": self.num_hashes,
+        }
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Build and query registered-name Bloom filters")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_cmd = commands.add_parser("build", help="Build a filter from zone files or name lists")
+    build_cmd.add_argument("sources", nargs="+", help="Zone files or name lists ('-' for stdin)")
+    build_cmd.add_argument("-o", "--output", required=True, help="Filter file to create or replace")
+    build_cmd.add_argument("--tld", help="Append this TLD to bare labels (zone files list bare labels)")
+    build_cmd.add_argument("--fp-rate", type=float, default=0.01, help="Target false-positive rate")
+    build_cmd.add_argument("--expected", type=int,
+                           help="Expected name count (default: count the sources first)")
+
+    check_cmd = commands.add_parser("check", help="Query a filter")
+    check_cmd.add_argument("filter", help="Filter file")
+    check_cmd.add_argument("domains", nargs="+", help="Fully qualified domain names")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        expected = args.expected
+        if expected is None:
+            if "-" in args.sources:
+                parser.error("--expected is required when reading stdin")
+            expected = sum(1 for _ in read_names(args.sources, args.tld))
+        started = time.time()
+        count = build(read_names(args.sources, args.tld), args.output, expected, args.fp_rate)
+        print(f"Wrote {count} names to {args.output} in {time.time() - started:.1f}s "
+              f"({os.path.getsize(args.output)} bytes)")
+        return 0
+
+    registered = RegisteredNameFilter(args.filter)
+    if not registered.loaded:
+        print(f"Could not load {args.filter}", file=sys.stderr)
+        return 1
+    for domain in args.domains:
+        verdict = "registered (probably)" if registered.might_be_registered(domain) else "not registered"
+        print(f"{normalize(domain)}: {verdict}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Claude Code API Server Benchmark
+
+Starts claude_server.py with bench/fake_claude.py on PATH as `claude`, drives
+/api/task, /api/bulk-task and /api/generate at the requested concurrency
+levels and cache-hit mix, and reports throughput, p50/p95/p99 latency and the
+server's peak RSS. Results can be saved as a baseline and later runs compared
+against it, so regressions in the cache or serving path show up as a non-zero
+exit status.
+
+Usage:
+    python bench_claude_server.py --scenario task --concurrency 1,8,32
+    python bench_claude_server.py --latency lognormal:0.8,0.6 --error-rate 0.02
+    python bench_claude_server.py --save-baseline baseline.json
+    python bench_claude_server.py --compare baseline.json --tolerance 0.15
+
+Baseline:
+    bench/baseline.json is the reference run, taken with the default settings
+    (all scenarios, concurrency 1,8,32, production mode). Compare a change
+    with it on the same machine, with the default settings:
+
+        python bench_claude_server.py --compare baseline.json
+
+    Absolute numbers depend on the host, which is recorded in meta.host and
+    flagged by --compare when it differs. On new hardware, re-save it with
+    --save-baseline from the base commit before comparing, and commit the
+    refreshed file whenever an intended change moves the numbers.
+
+    The committed run is from a single-CPU host. Each fake CLI call costs about
+    130 ms of CPU there, so throughput stops scaling between concurrency 8 and
+    32 (about 15 rps at a 50% hit mix) because the host runs out of CPU, not
+    because of the server.
+
+Requirements:
+    Only the standard library, plus the server's own dependencies
+    (gevent unless --dev is given). Linux is needed for RSS sampling.
+
+Output:
+    - A results table on stdout
+    - Optionally a baseline JSON file (--save-baseline), or a comparison with
+      one (--compare) that exits 1 on regressions beyond --tolerance
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(os.path.dirname(HERE), 'claude_server.py')
+FAKE_CLI = os.path.join(HERE, 'fake_claude.py')
+
+SCENARIOS = ('task', 'bulk', 'generate')
+HOT_PROMPTS = 10  # distinct prompts that make up the cache-hit share
+TASK_TYPES = ('financial', 'marketing', 'strategy', 'operations', 'general')
+LOWER_IS_BETTER = ('p50Ms', 'p95Ms', 'p99Ms', 'peakRssMb')
+HIGHER_IS_BETTER = ('throughputRps',)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def host_details():
+    """Where the numbers came from; comparing across hosts is not meaningful"""
+    cpu_model = platform.processor() or None
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    cpu_model = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'cpuModel': cpu_model
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_tree_rss_mb(root_pid):
+    """RSS of root_pid and its Python descendants (the fake CLIs are excluded)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    total = 0.0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as cmdline:
+                if b'fake_claude' in cmdline.read():
+                    continue
+            with open(f'/proc/{pid}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) / 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    """Track the peak RSS of the server process tree on a background thread"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.peak = process_tree_rss_mb(self.pid)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, process_tree_rss_mb(self.pid))
+
+
+class ServerUnderTest:
+    """claude_server.py running in a subprocess against the fake CLI"""
+
+    def __init__(self, args):
+        self.args = args
+        self.port = args.port or free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        self.bin_dir = None
+        self.proc = None
+        self.log = None
+
+    def __enter__(self):
+        self.bin_dir = tempfile.mkdtemp(prefix='fake-claude-')
+        fake = os.path.join(self.bin_dir, 'claude')
+        with open(fake, 'w') as script:
+            script.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_CLI}" "$@"\n')
+        os.chmod(fake, 0o755)
+
+        env = dict(os.environ)
+        env.pop('CLAUDE_BIN', None)
+        env['PATH'] = self.bin_dir + os.pathsep + env.get('PATH', '')
+        env['FAKE_CLAUDE_LATENCY'] = self.args.latency
+        env['FAKE_CLAUDE_STARTUP'] = str(self.args.startup)
+        env['FAKE_CLAUDE_ERROR_RATE'] = str(self.args.error_rate)
+        env['FAKE_CLAUDE_OUTPUT_CHARS'] = str(self.args.output_chars)
+        for setting in self.args.server_env:
+            key, _, value = setting.partition('=')
+            env[key] = value
+
+        command = [sys.executable, SERVER_SCRIPT, str(self.port)]
+        if not self.args.dev:
+            command.append('--production')
+        self.log = tempfile.NamedTemporaryFile(prefix='claude-server-', suffix='.log', delete=False)
+        self.proc = subprocess.Popen(command, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self._wait_ready()
+        return self
+
+    def __exit__(self, *exc):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self.bin_dir:
+            shutil.rmtree(self.bin_dir, ignore_errors=True)
+        if self.log:
+            self.log.close()
+
+    def _wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"Server exited with code {self.proc.returncode}, see {self.log.name}")
+            try:
+                with urllib.request.urlopen(self.base_url + '/health', timeout=1):
+                    return
+            except (urllib.error.URLError, OSError):
+                time.sleep(0.2)
+        raise RuntimeError(f"Server did not become ready within {timeout}s, see {self.log.name}")
+
+    def post(self, path, payload, timeout=120):
+        """POST JSON and return (HTTP status, parsed body)"""
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=json.dumps(payload).encode(),
+            headers={'Content-Type': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                return e.code, json.load(e)
+            except ValueError:
+                return e.code, {}
+
+
+def build_payload(scenario, hot_index, args):
+    """One request body; a hot_index selects one of the repeated, cacheable prompts"""
+    if hot_index is not None:
+        content = f"Summarize the cash position for plan {hot_index}"
+        task_type = 'financial'
+    else:
+        content = f"Summarize the cash position for request {uuid.uuid4().hex}"
+        task_type = random.choice(TASK_TYPES)
+
+    if scenario == 'task':
+        return '/api/task', {'businessId': 'bench', 'content': content, 'type': task_type}
+    if scenario == 'bulk':
+        return '/api/bulk-task', {
+            'businessIds': [f'bench-{i}' for i in range(args.bulk_size)],
+            'content': content,
+            'type': task_type
+        }
+    return '/api/generate', {'type': 'report', 'context': {'topic': content}, 'format': 'text'}
+
+
+def is_degraded(scenario, body):
+    """Whether a 200 response carried a fallback or per-item failures instead of answers"""
+    if scenario == 'bulk':
+        return any(not item.get('success') for item in body.get('results', []))
+    return bool(body.get('fallback'))
+
+
+def run_level(server, scenario, concurrency, args):
+    """Drive one scenario at one concurrency level and summarize it"""
+    rng = random.Random(args.seed)
+    server.post('/api/cache/clear', {})
+    if args.hit_ratio > 0:
+        # Warm the hot set so hits are hits from the first measured request
+        for index in range(HOT_PROMPTS):
+            server.post(*build_payload(scenario, index, args))
+
+    plan = [
+        build_payload(scenario, rng.randrange(HOT_PROMPTS) if rng.random() < args.hit_ratio else None, args)
+        for _ in range(args.requests)
+    ]
+    latencies = []
+    errors = 0
+    degraded = 0
+    lock = threading.Lock()
+
+    def fire(item):
+        nonlocal errors, degraded
+        path, payload = item
+        started = time.perf_counter()
+        try:
+            status, body = server.post(path, payload)
+        except (urllib.error.URLError, OSError):
+            status, body = 0, {}
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if status != 200:
+                errors += 1
+            elif is_degraded(scenario, body):
+                degraded += 1
+
+    with RssSampler(server.proc.pid) as rss:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(fire, plan))
+        wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': len(plan),
+        'throughputRps': round(len(plan) / wall, 2),
+        'p50Ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95Ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99Ms': round(percentile(latencies, 99) * 1000, 1),
+        'errors': errors,
+        'degraded': degraded,
+        'peakRssMb': round(rss.peak, 1)
+    }
+
+
+def print_table(results):
+    header = f"{'scenario':<10}{'conc':>6}{'reqs':>7}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}" \
+             f"{'p99 ms':>10}{'errors':>8}{'degraded':>10}{'rss MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for row in results:
+        print(f"{row['scenario']:<10}{row['concurrency']:>6}{row['requests']:>7}{row['throughputRps']:>10}"
+              f"{row['p50Ms']:>10}{row['p95Ms']:>10}{row['p99Ms']:>10}{row['errors']:>8}"
+              f"{row['degraded']:>10}{row['peakRssMb']:>9}")
+
+
+def compare(results, meta, baseline, tolerance):
+    """Print changes against a baseline and return the list of regressions"""
+    previous = {f"{row['scenario']}@{row['concurrency']}": row for row in baseline.get('results', [])}
+    regressions = []
+    print(f"\n📊 Compared with baseline from {baseline.get('meta', {}).get('createdAt', 'unknown')}"
+          f" (tolerance {tolerance:.0%})")
+    for key, value in meta.items():
+        if key != 'createdAt' and baseline.get('meta', {}).get(key) != value:
+            print(f"⚠️  Settings differ from the baseline: {key} was {baseline['meta'].get(key)!r}, now {value!r}")
+    for row in results:
+        key = f"{row['scenario']}@{row['concurrency']}"
+        old = previous.get(key)
+        if not old:
+            print(f"   {key}: no baseline entry")
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            if not old.get(metric):
+                continue
+            change = (row[metric] - old[metric]) / old[metric]
+            worse = change < -tolerance if metric in HIGHER_IS_BETTER else change > tolerance
+            marker = '❌' if worse else '  '
+            print(f" {marker} {key:<16}{metric:<15}{old[metric]:>10} -> {row[metric]:<10} ({change:+.1%})")
+            if worse:
+                regressions.append(f"{key} {metric}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark claude_server.py against a fake Claude CLI")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help="endpoint(s) to drive; repeat for several (default: all)")
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help="comma-separated concurrency levels (default: 1,8,32)")
+    parser.add_argument('--requests', type=int, default=200, help="requests per level (default: 200)")
+    parser.add_argument('--hit-ratio', type=float, default=0.5,
+                        help="share of requests drawn from a small repeated set (default: 0.5)")
+    parser.add_argument('--bulk-size', type=int, default=20, help="businesses per bulk request (default: 20)")
+    parser.add_argument('--latency', default='lognormal:0.5,0.5',
+                        help="fake CLI latency: fixed:S, uniform:LO,HI or lognormal:MEDIAN,SIGMA")
+    parser.add_argument('--startup', type=float, default=0.3, help="fake CLI boot time in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fake CLI failure rate")
+    parser.add_argument('--output-chars', type=int, default=400, help="fake CLI answer size")
+    parser.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE',
+                        help="extra environment for the server, e.g. CLAUDE_POOL_SIZE=4")
+    parser.add_argument('--dev', action='store_true', help="use the Werkzeug dev server instead of gevent")
+    parser.add_argument('--port', type=int, help="server port (default: a free one)")
+    parser.add_argument('--seed', type=int, default=1234, help="seed for the request mix")
+    parser.add_argument('--save-baseline', metavar='PATH', help="write results to a baseline JSON file")
+    parser.add_argument('--compare', metavar='PATH', help="compare with a baseline and fail on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help="allowed relative change before a metric counts as regressed (default: 0.10)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = args.scenario or list(SCENARIOS)
+    levels = [int(level) for level in args.concurrency.split(',') if level]
+
+    print(f"🚀 Benchmarking claude_server.py ({'dev' if args.dev else 'production'} mode)")
+    print(f"🤖 Fake CLI: latency {args.latency}, startup {args.startup}s, "
+          f"errors {args.error_rate:.0%}, {args.output_chars} chars")
+    print(f"🎯 {args.requests} requests per level, {args.hit_ratio:.0%} cache-hit mix")
+    print("-" * 50)
+
+    results = []
+    with ServerUnderTest(args) as server:
+        for scenario in scenarios:
+            for concurrency in levels:
+                print(f"⏱️  {scenario} @ concurrency {concurrency}...")
+                results.append(run_level(server, scenario, concurrency, args))
+    print()
+    print_table(results)
+
+    meta = {
+        'createdAt': datetime.now().isoformat(),
+        'latency': args.latency,
+        'startup': args.startup,
+        'errorRate': args.error_rate,
+        'outputChars': args.output_chars,
+        'hitRatio': args.hit_ratio,
+        'requests': args.requests,
+        'bulkSize': args.bulk_size,
+        'mode': 'dev' if args.dev else 'production',
+        'serverEnv': args.server_env,
+        'host': host_details()
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        print(f"\n💾 Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, meta, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n❌ {len(regressions)} regression(s): {', '.join(regressions)}")
+            return 1
+        print("\n✅ No regressions beyond tolerance")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Fake Claude CLI for benchmarking claude_server.py
+
+Accepts the same invocation the server uses (`--print --output-format
+text|json|stream-json`, prompt on stdin) and answers after a simulated
+delay, so the serving path can be load-tested without calling the real CLI.
+bench_claude_server.py installs it on PATH as `claude`.
+
+Behaviour is set through environment variables:
+    FAKE_CLAUDE_LATENCY       fixed:S | uniform:LO,HI | lognormal:MEDIAN,SIGMA
+                              (seconds, default fixed:0.5)
+    FAKE_CLAUDE_STARTUP       seconds spent "booting" before stdin is read,
+                              which pre-warmed workers hide (default 0)
+    FAKE_CLAUDE_ERROR_RATE    fraction of calls that exit non-zero (default 0)
+    FAKE_CLAUDE_OUTPUT_CHARS  size of each answer in characters (default 400)
+
+Batched prompts from the server's micro-batcher get a JSON array with one
+answer per question.
+"""
+
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+
+STREAM_CHUNK_CHARS = 40
+
+
+def sample_latency(spec: str) -> float:
+    """Draw one latency in seconds from a FAKE_CLAUDE_LATENCY spec"""
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',') if value]
+    if kind == 'fixed':
+        return values[0]
+    if kind == 'uniform':
+        return random.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        median, sigma = values
+        return random.lognormvariate(math.log(median), sigma)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def make_answer(prompt: str, size: int) -> str:
+    """Deterministic filler text of `size` characters that mentions the prompt"""
+    head = f"Answer to: {' '.join(prompt.split())[:60]}. "
+    filler = "Revenue grew while costs held steady across the quarter. "
+    text = head + filler * (size // len(filler) + 1)
+    return text[:max(size, 1)]
+
+
+def main():
+    if '--version' in sys.argv:
+        print('fake-claude 1.0 (benchmark)')
+        return 0
+
+    time.sleep(float(os.environ.get('FAKE_CLAUDE_STARTUP', '0')))
+    prompt = sys.stdin.read()
+    output_format = 'text'
+    if '--output-format' in sys.argv:
+        output_format = sys.argv[sys.argv.index('--output-format') + 1]
+
+    time.sleep(sample_latency(os.environ.get('FAKE_CLAUDE_LATENCY', 'fixed:0.5')))
+    if random.random() < float(os.environ.get('FAKE_CLAUDE_ERROR_RATE', '0')):
+        print("Simulated CLI failure", file=sys.stderr)
+        return 1
+
+    size = int(os.environ.get('FAKE_CLAUDE_OUTPUT_CHARS', '400'))
+    if prompt.startswith('Answer each of the following'):
+        questions = re.findall(r'Question \d+:\n(.*?)(?:\n\n|$)', prompt, re.S)
+        print(json.dumps([make_answer(question, size) for question in questions]))
+        return 0
+
+    answer = make_answer(prompt, size)
+    if output_format == 'stream-json':
+        for start in range(0, len(answer), STREAM_CHUNK_CHARS):
+            delta = {'type': 'text_delta', 'text': answer[start:start + STREAM_CHUNK_CHARS]}
+            print(json.dumps({'type': 'stream_event', 'event': {'type': 'content_block_delta', 'delta': delta}}),
+                  flush=True)
+        print(json.dumps({'type': 'result', 'subtype': 'success', 'is_error': False, 'result': answer}))
+    elif output_format == 'json':
+        print(json.dumps({'type': 'result', 'subtype': 'success', 'is_error': False, 'result': answer}))
+    else:
+        print(answer)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,316 +11,3169 @@ Uses uv for Python package management
 # dependencies = [
 #     "flask>=3.0.0",
 #     "flask-cors>=4.0.0",
+#     "prometheus-client>=0.19.0",
+#     "gevent>=24.2.1",
+#     "brotli>=1.1.0",
 # ]
 # ///
 
-from flask import Flask, request, jsonify
+import os
+import sys
+
+# Production mode runs on a gevent event loop: sockets, subprocess pipes, locks
+# and threads all become cooperative, so hundreds of requests waiting on the
+# CLI share one OS thread. Patching has to happen before anything imports them
+SERVER_MODE = 'production' if '--production' in sys.argv[1:] else os.environ.get('CLAUDE_SERVER_MODE', 'development')
+if SERVER_MODE == 'production':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+    generate_latest, multiprocess
+)
 import subprocess
 import json
+import math
+import atexit
+import functools
 import hashlib
-from typing import Optional, Dict, Any
+import heapq
+import queue
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+import unicodedata
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from typing import Optional, Dict, Any, List, Callable, Iterator, Tuple
+from urllib.parse import urlparse
 import logging
 from datetime import datetime
 
+try:
+    import brotli  # without it responses are only ever gzip-compressed
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for frontend access
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Prometheus metrics. Counters are thread-safe; when running several worker
+# processes set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates all of them
+TASK_TYPES = ('financial', 'marketing', 'strategy', 'operations', 'general')
+
+SPAWN_SECONDS = Histogram(
+    'claude_server_subprocess_spawn_seconds', 'Time to spawn a Claude CLI process',
+    ['path'], buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+CLI_SECONDS = Histogram(
+    'claude_server_cli_execution_seconds', 'Time from sending a prompt to the CLI exiting',
+    ['mode', 'outcome'], buckets=(0.25, 0.5, 1, 2, 5, 10, 15, 20, 30, 45, 60)
+)
+REQUEST_SECONDS = Histogram(
+    'claude_server_request_seconds', 'Total HTTP request time including streaming',
+    ['endpoint'], buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60)
+)
+CACHE_LOOKUPS = Counter(
+    'claude_server_cache_lookups_total', 'Result cache lookups', ['endpoint', 'task_type', 'result']
+)
+CLI_TIMEOUTS = Counter('claude_server_cli_timeouts_total', 'Claude CLI calls that timed out', ['mode'])
+FALLBACKS = Counter(
+    'claude_server_fallback_responses_total', 'Canned responses served instead of Claude', ['task_type']
+)
+COALESCED = Counter(
+    'claude_server_coalesced_requests_total', 'Requests that waited on an identical in-flight call',
+    ['source']
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'claude_server_requests_in_flight', 'HTTP requests being served', ['endpoint'],
+    multiprocess_mode='livesum'
+)
+CLI_IN_FLIGHT = Gauge(
+    'claude_server_cli_processes_in_flight', 'Claude CLI processes answering a prompt',
+    multiprocess_mode='livesum'
+)
+CACHE_BYTES = Gauge(
+    'claude_server_cache_bytes', 'Bytes held by the in-memory result cache', multiprocess_mode='livesum'
+)
+CACHE_ENTRIES = Gauge(
+    'claude_server_cache_entries', 'Entries in the in-memory result cache', multiprocess_mode='livesum'
+)
+CONCURRENCY_LIMIT = Gauge(
+    'claude_server_concurrency_limit', 'Current adaptive limit on concurrent CLI calls',
+    multiprocess_mode='livesum'
+)
+LOAD_SHED = Counter(
+    'claude_server_load_shed_total', 'CLI calls rejected without running', ['reason']
+)
+HEDGES = Counter(
+    'claude_server_hedged_queries_total', 'Queries that sent a second, hedge invocation',
+    ['winner']
+)
+HEDGES_DENIED = Counter(
+    'claude_server_hedges_denied_total', 'Hedges skipped because the hedge budget was spent'
+)
+CIRCUIT_STATE = Gauge(
+    'claude_server_circuit_state', 'Circuit breaker state (0 closed, 1 half-open, 2 open)',
+    multiprocess_mode='max'
+)
+
+
+def task_type_of(data: Dict[str, Any]) -> str:
+    """A payload's task type; a missing or null "type" means general"""
+    return str(data.get('type') or 'general')
+
+def task_label(task_type: str) -> str:
+    """Bound metric label cardinality for client-supplied task types"""
+    return task_type if task_type in TASK_TYPES else 'other'
+
+# Claude CLI invocation and pre-warmed worker pool
+CLAUDE_BIN = os.environ.get('CLAUDE_BIN', 'claude')
+CLI_TIMEOUT = float(os.environ.get('CLAUDE_CLI_TIMEOUT', '30'))
+CLI_POOL_SIZE = int(os.environ.get('CLAUDE_POOL_SIZE', '2'))  # spares per argument set, 0 disables
+CLI_WORKER_MAX_AGE = float(os.environ.get('CLAUDE_WORKER_MAX_AGE', '300'))
+CLI_WORKER_MAX_RSS_MB = int(os.environ.get('CLAUDE_WORKER_MAX_RSS_MB', '512'))
+
+# Production server (--production or CLAUDE_SERVER_MODE=production): greenlet
+# limit and how long in-flight requests may finish after SIGTERM/SIGINT
+SERVER_MAX_CONNECTIONS = int(os.environ.get('CLAUDE_SERVER_MAX_CONNECTIONS', '1000'))
+SHUTDOWN_GRACE = float(os.environ.get('CLAUDE_SHUTDOWN_GRACE', str(CLI_TIMEOUT + 5)))
+
+# Hedged queries: once a call outlives this percentile of recent latencies a
+# second identical call is sent (0 disables). The budget caps hedges at that
+# fraction of queries
+HEDGE_PERCENTILE = float(os.environ.get('CLAUDE_HEDGE_PERCENTILE', '0'))
+HEDGE_BUDGET = float(os.environ.get('CLAUDE_HEDGE_BUDGET', '0.05'))
+HEDGE_MIN_SAMPLES = int(os.environ.get('CLAUDE_HEDGE_MIN_SAMPLES', '20'))
+HEDGE_WINDOW = int(os.environ.get('CLAUDE_HEDGE_WINDOW', '200'))
+
+# Adaptive concurrency limit on CLI calls (AIMD). Callers over the limit wait
+# in a queue that by default admits every connection the server accepts, for
+# up to one CLI timeout; the limit shrinks when short-term smoothed latency
+# exceeds CONCURRENCY_TOLERANCE x the long-run average or a call times out
+CONCURRENCY_INITIAL = int(os.environ.get('CLAUDE_CONCURRENCY_INITIAL', '16'))
+CONCURRENCY_MIN = int(os.environ.get('CLAUDE_CONCURRENCY_MIN', '1'))
+CONCURRENCY_MAX = int(os.environ.get('CLAUDE_CONCURRENCY_MAX', '128'))
+CONCURRENCY_QUEUE = int(os.environ.get('CLAUDE_CONCURRENCY_QUEUE', str(SERVER_MAX_CONNECTIONS)))
+CONCURRENCY_QUEUE_TIMEOUT = float(os.environ.get('CLAUDE_CONCURRENCY_QUEUE_TIMEOUT', str(CLI_TIMEOUT)))
+CONCURRENCY_TOLERANCE = float(os.environ.get('CLAUDE_CONCURRENCY_TOLERANCE', '2'))
+
+# Circuit breaker: trips when the failure rate over the last BREAKER_WINDOW
+# calls reaches BREAKER_FAILURE_RATE, then probes every BREAKER_COOLDOWN seconds
+BREAKER_WINDOW = int(os.environ.get('CLAUDE_BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.environ.get('CLAUDE_BREAKER_MIN_CALLS', '10'))
+BREAKER_FAILURE_RATE = float(os.environ.get('CLAUDE_BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_COOLDOWN = float(os.environ.get('CLAUDE_BREAKER_COOLDOWN', '15'))
+BREAKER_HALF_OPEN_CALLS = int(os.environ.get('CLAUDE_BREAKER_HALF_OPEN_CALLS', '3'))
+
+# Bulk execution: worker pool size and default per-request deadline (seconds)
+BULK_MAX_WORKERS = int(os.environ.get('CLAUDE_BULK_WORKERS', '4'))
+BULK_DEFAULT_DEADLINE = float(os.environ.get('CLAUDE_BULK_DEADLINE', '60'))
+
+# Opt-in micro-batching of short prompts (window 0 disables it)
+BATCH_WINDOW_MS = float(os.environ.get('CLAUDE_BATCH_WINDOW_MS', '0'))
+BATCH_MAX_SIZE = int(os.environ.get('CLAUDE_BATCH_MAX_SIZE', '8'))
+BATCH_MAX_PROMPT_CHARS = int(os.environ.get('CLAUDE_BATCH_MAX_PROMPT_CHARS', '500'))
+BATCH_TASK_TYPES = set(os.environ.get('CLAUDE_BATCH_TASK_TYPES', 'general,financial').split(','))
+
+# Background jobs: worker threads, queue bound, finished jobs kept for polling
+JOB_WORKERS = int(os.environ.get('CLAUDE_JOB_WORKERS', '4'))
+JOB_MAX_QUEUED = int(os.environ.get('CLAUDE_JOB_MAX_QUEUED', '10000'))
+JOB_RETENTION = int(os.environ.get('CLAUDE_JOB_RETENTION', '1000'))
+JOB_CALLBACK_ATTEMPTS = 3
+
+# Lower tier number is served first
+JOB_PRIORITIES = {'interactive': 0, 'normal': 1, 'bulk': 2}
+
+# Cache limits (override via environment)
+CACHE_MAX_ENTRIES = int(os.environ.get('CLAUDE_CACHE_MAX_ENTRIES', '5000'))
+CACHE_MAX_BYTES = int(os.environ.get('CLAUDE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CACHE_DEFAULT_TTL = int(os.environ.get('CLAUDE_CACHE_DEFAULT_TTL', '21600'))
+
+# Optional on-disk cache shared by all server processes on this host
+CACHE_DB_PATH = os.environ.get('CLAUDE_CACHE_DB', '')
+
+# Per task_type TTLs in seconds; CLAUDE_CACHE_TTLS="financial=900,marketing=86400"
+CACHE_TASK_TTLS = {
+    'financial': 3600,
+    'marketing': 86400,
+    'strategy': 86400,
+    'operations': 86400,
+    'general': 21600,
+    'generate': 86400,  # all /api/generate content types ("generate:<type>")
+}
+for _item in filter(None, os.environ.get('CLAUDE_CACHE_TTLS', '').split(',')):
+    _type, _, _ttl = _item.partition('=')
+    CACHE_TASK_TTLS[_type.strip()] = int(_ttl)
+
+# Cache key canonicalization steps, applied in order (see KEY_NORMALIZERS)
+CACHE_KEY_PIPELINE = os.environ.get(
+    'CLAUDE_CACHE_KEY_PIPELINE', 'unicode,casefold,punctuation,whitespace,filler'
+).split(',')
+
+# Serve cached answers for near-duplicate prompts at or above this Jaccard
+# similarity of word shingles; unset or 0 disables near-duplicate lookup
+NEAR_DUP_THRESHOLD = float(os.environ.get('CLAUDE_NEAR_DUP_THRESHOLD', '0'))
+
+# Fixed per-entry overhead (key, metadata, dict slots) added to the result size
+CACHE_ENTRY_OVERHEAD = 256
+
+# Response bodies at least this large are compressed. Cached results this
+# large also keep a pre-deflated copy so hits are not compressed again
+COMPRESS_MIN_BYTES = int(os.environ.get('CLAUDE_COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Keys tracked by the hot-key sketch; the top of it is reported by /api/cache/hot
+CACHE_HOT_KEYS = int(os.environ.get('CLAUDE_CACHE_HOT_KEYS', '100'))
+
+
+FILLER_PATTERN = re.compile(
+    r'(?:\s+(?:please|pls|plz|thanks|thank you|thx|asap|if possible|for me))+\s*$'
+)
+
+# Punctuation that carries meaning and survives stripping: a number with its
+# sign, decimal/thousands separators and percent sign, and #, +, @ or &
+# attached to a word ("C#", "C++", "AT&T", "@team")
+PROTECTED_TOKEN = re.compile(
+    r'[-+\u2212]?[.,]?\d(?:[\d.,]*\d)?%?'
+    r'|(?<=\w)[#+@&]+|[#+@&]+(?=\w)'
+)
+
+
+def _normalize_unicode(text: str) -> str:
+    return unicodedata.normalize('NFKC', text)
+
+
+def _casefold(text: str) -> str:
+    return text.casefold()
+
+
+def _blank_punctuation(text: str) -> str:
+    # Replace rather than delete so words either side stay apart
+    return ''.join(' ' if unicodedata.category(ch).startswith('P') else ch for ch in text)
+
+
+def _strip_punctuation(text: str) -> str:
+    # "-20%" must not collide with "20", nor "C#" with "C"
+    pieces = []
+    last = 0
+    for match in PROTECTED_TOKEN.finditer(text):
+        pieces.append(_blank_punctuation(text[last:match.start()]))
+        pieces.append(match.group())
+        last = match.end()
+    pieces.append(_blank_punctuation(text[last:]))
+    return ''.join(pieces)
+
+
+def _collapse_whitespace(text: str) -> str:
+    return ' '.join(text.split())
+
+
+def _strip_filler(text: str) -> str:
+    return FILLER_PATTERN.sub('', ' ' + text).strip()
+
+
+# Available canonicalization steps; register new ones here and list them in
+# CLAUDE_CACHE_KEY_PIPELINE to change how prompts map to cache keys
+KEY_NORMALIZERS: Dict[str, Callable[[str], str]] = {
+    'unicode': _normalize_unicode,
+    'casefold': _casefold,
+    'punctuation': _strip_punctuation,
+    'whitespace': _collapse_whitespace,
+    'filler': _strip_filler,
+}
+
+
+def canonicalize_prompt(prompt: str) -> str:
+    """Run a prompt through the configured key canonicalization pipeline"""
+    for name in CACHE_KEY_PIPELINE:
+        prompt = KEY_NORMALIZERS[name.strip()](prompt)
+    return prompt
+
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index over word shingles of canonical prompts
+
+    LSH banding narrows a lookup to cached prompts of the same task_type that
+    share at least one band of their MinHash signature; candidates are then
+    scored by exact Jaccard similarity of their shingle sets, which is the
+    similarity reported to clients. Only the in-memory cache tier is indexed:
+    the cache adds entries as they enter memory (including store read-throughs)
+    and removes them as they leave, under its own lock.
+    """
+
+    NUM_PERM = 64
+    BANDS = 16
+    SHINGLE_SIZE = 2
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        rng = random.Random(0x5EED)
+        self._perms = [
+            (rng.randrange(1, self._PRIME), rng.randrange(0, self._PRIME))
+            for _ in range(self.NUM_PERM)
+        ]
+        self._buckets: Dict[tuple, set] = {}
+        self._entries: Dict[str, Tuple[frozenset, List[tuple]]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, prompt: str, task_type: str):
+        signature = self.signature(prompt, task_type)
+        if signature is not None:
+            self._add(key, signature)
+
+    def signature(self, prompt: str, task_type: str) -> Optional[Tuple[frozenset, List[tuple]]]:
+        """(shingles, LSH bands) of a prompt; the MinHash is the costly part"""
+        shingles = self._shingles(prompt)
+        if not shingles:
+            return None
+        return shingles, self._bands(shingles, task_type)
+
+    def prepare_entry(self, entry: Dict[str, Any]):
+        """ResultCache.on_prepare hook: sign the prompt before the cache lock is taken"""
+        if entry.get('prompt'):
+            entry['_signature'] = self.signature(entry['prompt'], entry['task_type'])
+
+    def add_entry(self, key: str, entry: Dict[str, Any]):
+        """ResultCache.on_insert hook; entries stored without a prompt are skipped"""
+        signature = entry.pop('_signature', None)
+        if signature is None and entry.get('prompt'):
+            signature = self.signature(entry['prompt'], entry['task_type'])
+        if signature is not None:
+            self._add(key, signature)
+
+    def _add(self, key: str, signature: Tuple[frozenset, List[tuple]]):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = signature
+            for band in signature[1]:
+                self._buckets.setdefault(band, set()).add(key)
+
+    def remove(self, key: str):
+        with self._lock:
+            self._discard(key)
+
+    def lookup(self, prompt: str, task_type: str) -> Optional[Tuple[str, float]]:
+        """Best indexed (key, similarity) at or above the threshold, if any"""
+        shingles = self._shingles(prompt)
+        if not shingles:
+            return None
+        bands = self._bands(shingles, task_type)
+        best = None
+        with self._lock:
+            candidates = set()
+            for band in bands:
+                candidates.update(self._buckets.get(band, ()))
+            for key in candidates:
+                other = self._entries[key][0]
+                similarity = len(shingles & other) / len(shingles | other)
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (key, similarity)
+        return best
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for band in entry[1]:
+            bucket = self._buckets.get(band)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band]
+
+    def _shingles(self, prompt: str) -> frozenset:
+        words = canonicalize_prompt(prompt).split()
+        size = min(self.SHINGLE_SIZE, len(words))
+        grams = [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)] if words else []
+        return frozenset(zlib.crc32(gram.encode('utf-8')) for gram in grams)
+
+    def _bands(self, shingles: frozenset, task_type: str) -> List[tuple]:
+        prime = self._PRIME
+        signature = [min((a * h + b) % prime for h in shingles) for a, b in self._perms]
+        rows = self.NUM_PERM // self.BANDS
+        return [
+            (task_type, band, tuple(signature[band * rows:(band + 1) * rows]))
+            for band in range(self.BANDS)
+        ]
+
+
+class SpaceSaving:
+    """
+    Space-Saving top-k sketch of the most frequently looked-up keys
+
+    Holds at most `capacity` counters. A new key replaces the one with the
+    smallest count and inherits that count (recorded as its error), so any
+    key looked up more than total/capacity times is guaranteed to be present
+    and each reported count overestimates the true count by at most `error`.
+
+    Keys are also grouped into buckets by count (the stream-summary layout).
+    Counts only ever grow by one, so finding the smallest counter and moving
+    a key up are both O(1) and offer() stays cheap under the cache lock.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._counts: Dict[str, List[int]] = {}  # key -> [count, error]
+        self._buckets: Dict[int, "OrderedDict[str, None]"] = {}  # count -> keys, oldest first
+        self._min = 0
+        self.total = 0
+
+    def offer(self, key: str):
+        self.total += 1
+        counter = self._counts.get(key)
+        if counter is not None:
+            count = counter[0]
+            bucket = self._buckets[count]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[count]
+        elif len(self._counts) < self.capacity:
+            count = 0
+            counter = self._counts[key] = [0, 0]
+        else:
+            # Replace the longest-standing key among those with the smallest count
+            count = self._min
+            bucket = self._buckets[count]
+            victim, _ = bucket.popitem(last=False)
+            if not bucket:
+                del self._buckets[count]
+            del self._counts[victim]
+            counter = self._counts[key] = [count, count]
+
+        counter[0] = count + 1
+        self._buckets.setdefault(count + 1, OrderedDict())[key] = None
+        if count == 0 or self._min not in self._buckets:
+            self._min = count + 1
+
+    def top(self, n: int) -> List[Tuple[str, int, int]]:
+        """The n heaviest keys as (key, count, error), heaviest first"""
+        ranked = heapq.nlargest(n, self._counts.items(), key=lambda item: item[1][0])
+        return [(key, count, error) for key, (count, error) in ranked]
+
+    def clear(self):
+        self._counts.clear()
+        self._buckets.clear()
+        self._min = 0
+        self.total = 0
+
+
+class RecencyList:
+    """
+    Keys from least to most recently used, as a doubly linked list in a dict
+
+    Does what the cache needs from an OrderedDict (append, move to the end,
+    pop the oldest) but can also start a walk at any key, so pages of the
+    cache resume from a key cursor instead of skipping an offset.
+    """
+
+    def __init__(self):
+        self._links: Dict[str, List[Optional[str]]] = {}  # key -> [older, newer]
+        self.oldest: Optional[str] = None
+        self.newest: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self._links)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._links
+
+    def append(self, key: str):
+        """Add a key that is not in the list as the most recently used"""
+        self._links[key] = [self.newest, None]
+        if self.newest is None:
+            self.oldest = key
+        else:
+            self._links[self.newest][1] = key
+        self.newest = key
+
+    def remove(self, key: str):
+        older, newer = self._links.pop(key)
+        if older is None:
+            self.oldest = newer
+        else:
+            self._links[older][1] = newer
+        if newer is None:
+            self.newest = older
+        else:
+            self._links[newer][0] = older
+
+    def move_to_end(self, key: str):
+        if key != self.newest:
+            self.remove(key)
+            self.append(key)
+
+    def older_than(self, key: Optional[str]) -> Iterator[str]:
+        """Keys from newest to oldest, starting just past `key` when given"""
+        current = self.newest if key is None else self._links[key][0]
+        while current is not None:
+            # Read the link before yielding, in case the caller removes current
+            older = self._links[current][0]
+            yield current
+            current = older
+
+    def clear(self):
+        self._links.clear()
+        self.oldest = self.newest = None
+
+
+def task_type_matches(task_type: str, wanted: str) -> bool:
+    """Exact or family match, e.g. generate covers generate:email"""
+    return task_type == wanted or task_type.startswith(wanted + ':')
+
+
+def _off_event_loop(method):
+    """
+    Run a blocking SQLite call on gevent's native threadpool in production
+    mode. sqlite3 is not cooperative, so a lock wait inside the busy timeout
+    would otherwise freeze every greenlet on the hub
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if SERVER_MODE == 'production':
+            import gevent
+            return gevent.get_hub().threadpool.apply(method, (self,) + args, kwargs)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class SQLiteCacheStore:
+    """
+    Persistent cache backend in a SQLite database running in WAL mode
+
+    Nothing is read at startup: rows are fetched on demand by key, so a large
+    store does not slow boot. WAL plus a busy timeout lets several server
+    processes on the same host share one file. A generation counter bumped by
+    clear() lets every process notice that its memory tier is stale. Under
+    gevent every query runs on the hub's threadpool (see _off_event_loop).
+
+    Entry and byte totals per task_type live in cache_type_totals, kept up to
+    date by triggers on every insert, update and delete, so stats() reads a
+    handful of rows instead of scanning the table.
+    """
+
+    PURGE_EVERY = 500  # writes between sweeps of expired rows
+    GENERATION_CHECK_INTERVAL = 1.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._generation = 0
+        self._generation_checked = 0.0
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections are not shareable across threads; keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    task_type TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    prompt TEXT
+                )
+            """)
+            self._add_prompt_column(conn)
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache_entries (expires_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO cache_meta (name, value) VALUES ('generation', 0)")
+            self._add_type_totals(conn)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _add_type_totals(conn: sqlite3.Connection):
+        """
+        Create the per-type totals and their triggers, backfilling them once
+        from the existing rows. The check runs under a write lock so two
+        processes opening an older database don't both backfill
+        """
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_type_totals (
+                    task_type TEXT PRIMARY KEY,
+                    entries INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS cache_totals_insert AFTER INSERT ON cache_entries BEGIN
+                    INSERT INTO cache_type_totals (task_type, entries, bytes) VALUES (NEW.task_type, 1, NEW.size)
+                    ON CONFLICT (task_type) DO UPDATE SET entries = entries + 1, bytes = bytes + NEW.size;
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS cache_totals_delete AFTER DELETE ON cache_entries BEGIN
+                    UPDATE cache_type_totals SET entries = entries - 1, bytes = bytes - OLD.size
+                    WHERE task_type = OLD.task_type;
+                    DELETE FROM cache_type_totals WHERE task_type = OLD.task_type AND entries <= 0;
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS cache_totals_update AFTER UPDATE OF task_type, size ON cache_entries BEGIN
+                    UPDATE cache_type_totals SET entries = entries - 1, bytes = bytes - OLD.size
+                    WHERE task_type = OLD.task_type;
+                    DELETE FROM cache_type_totals WHERE task_type = OLD.task_type AND entries <= 0;
+                    INSERT INTO cache_type_totals (task_type, entries, bytes) VALUES (NEW.task_type, 1, NEW.size)
+                    ON CONFLICT (task_type) DO UPDATE SET entries = entries + 1, bytes = bytes + NEW.size;
+                END
+            """)
+            backfilled = conn.execute(
+                "SELECT 1 FROM cache_meta WHERE name = 'type_totals'"
+            ).fetchone()
+            if backfilled is None:
+                conn.execute('DELETE FROM cache_type_totals')
+                conn.execute(
+                    'INSERT INTO cache_type_totals (task_type, entries, bytes) '
+                    'SELECT task_type, COUNT(*), SUM(size) FROM cache_entries GROUP BY task_type'
+                )
+                conn.execute("INSERT INTO cache_meta (name, value) VALUES ('type_totals', 1)")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _add_prompt_column(conn: sqlite3.Connection):
+        """Databases created before prompts were stored lack the column"""
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(cache_entries)')}
+        if 'prompt' not in columns:
+            try:
+                conn.execute('ALTER TABLE cache_entries ADD COLUMN prompt TEXT')
+            except sqlite3.OperationalError:
+                pass  # another process added it first
+
+    @_off_event_loop
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            'SELECT result, task_type, timestamp, expires_at, size, prompt FROM cache_entries '
+            'WHERE key = ? AND expires_at > ?',
+            (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'result': json.loads(row[0]),
+            'task_type': row[1],
+            'timestamp': row[2],
+            'expires_at': row[3],
+            'size': row[4],
+            'prompt': row[5]
+        }
+
+    @_off_event_loop
+    def set(self, key: str, entry: Dict[str, Any]):
+        conn = self._conn()
+        # An upsert rather than INSERT OR REPLACE: REPLACE deletes the old row
+        # without firing the delete trigger, which would skew the totals
+        conn.execute(
+            'INSERT INTO cache_entries '
+            '(key, result, task_type, timestamp, expires_at, size, prompt) VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET result = excluded.result, task_type = excluded.task_type, '
+            'timestamp = excluded.timestamp, expires_at = excluded.expires_at, size = excluded.size, '
+            'prompt = excluded.prompt',
+            (key, json.dumps(entry['result']), entry['task_type'], entry['timestamp'],
+             entry['expires_at'], entry['size'], entry.get('prompt'))
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM cache_entries WHERE expires_at <= ?', (time.time(),))
+
+    @_off_event_loop
+    def clear(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM cache_entries')
+            conn.execute("UPDATE cache_meta SET value = value + 1 WHERE name = 'generation'")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._generation_checked = 0.0
+
+    @_off_event_loop
+    def invalidate(self, task_type: Optional[str], key_prefix: Optional[str]) -> Tuple[int, int]:
+        """
+        Delete rows matching the type and/or key prefix and bump the generation
+        so other processes drop their memory tier. Returns (rows, generation)
+        """
+        clauses, params = [], []
+        if task_type:
+            clauses.append('(task_type = ? OR substr(task_type, 1, ?) = ?)')
+            params.extend([task_type, len(task_type) + 1, task_type + ':'])
+        if key_prefix:
+            clauses.append('substr(key, 1, ?) = ?')
+            params.extend([len(key_prefix), key_prefix])
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            removed = conn.execute(
+                f"DELETE FROM cache_entries WHERE {' AND '.join(clauses)}", params
+            ).rowcount
+            conn.execute("UPDATE cache_meta SET value = value + 1 WHERE name = 'generation'")
+            generation = conn.execute(
+                "SELECT value FROM cache_meta WHERE name = 'generation'"
+            ).fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._generation = generation
+        self._generation_checked = time.monotonic()
+        return removed, generation
+
+    def generation(self) -> int:
+        """Clear generation, re-read from disk at most once per interval"""
+        now = time.monotonic()
+        if now - self._generation_checked >= self.GENERATION_CHECK_INTERVAL:
+            self._generation = self._read_generation()
+            self._generation_checked = now
+        return self._generation
+
+    @_off_event_loop
+    def _read_generation(self) -> int:
+        row = self._conn().execute(
+            "SELECT value FROM cache_meta WHERE name = 'generation'"
+        ).fetchone()
+        return row[0] if row else 0
+
+    @_off_event_loop
+    def stats(self) -> Dict[str, Any]:
+        """Totals per task_type; rows past expiry count until the next purge"""
+        rows = self._conn().execute(
+            'SELECT task_type, entries, bytes FROM cache_type_totals'
+        ).fetchall()
+        return {
+            'backend': 'sqlite',
+            'path': self.path,
+            'entries': sum(row[1] for row in rows),
+            'bytes': sum(row[2] for row in rows),
+            'byType': {row[0]: {'entries': row[1], 'bytes': row[2]} for row in rows}
+        }
+
+
+class ResultCache:
+    """
+    Bounded in-memory LRU cache for Claude results
+
+    Caps both the number of entries and the total result bytes, expires
+    entries per task_type TTL, and keeps running counters so stats are O(1).
+    With a persistent store attached, memory acts as the hot tier: misses are
+    read through from the store and writes go to both. Entry counts and bytes
+    per task_type are maintained incrementally, and every lookup feeds a
+    Space-Saving sketch of the hottest keys.
+    """
+
+    PAGE_SCAN_LIMIT = 5000  # entries looked at per page() call
+
+    def __init__(self, max_entries: int, max_bytes: int,
+                 default_ttl: int, task_ttls: Dict[str, int],
+                 store: Optional[SQLiteCacheStore] = None, hot_keys: int = 100):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.task_ttls = task_ttls
+        self.store = store
+        # Called before the cache lock is taken on an entry about to enter the
+        # memory tier, for expensive preparation; then under the lock as keys
+        # enter and leave it
+        self.on_prepare: Optional[Callable[[Dict[str, Any]], None]] = None
+        self.on_insert: Optional[Callable[[str, Dict[str, Any]], None]] = None
+        self.on_remove: Optional[Callable[[str], None]] = None
+        self._store_generation = None
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._recency = RecencyList()
+        self._expiry_heap: List[tuple] = []
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._by_type: Dict[str, List[int]] = {}  # task_type -> [entries, bytes]
+        self._hot_keys = SpaceSaving(hot_keys)
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self.store_errors = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def ttl_for(self, task_type: str) -> int:
+        # "generate:email" falls back to the "generate" TTL
+        ttl = self.task_ttls.get(task_type)
+        if ttl is None:
+            ttl = self.task_ttls.get(task_type.split(':', 1)[0], self.default_ttl)
+        return ttl
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the live entry for key (refreshing its LRU position) or None"""
+        self._sync_store_generation()
+        with self._lock:
+            self._hot_keys.offer(key)
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                self._publish_size()
+                entry = None
+            if entry is not None:
+                self._recency.move_to_end(key)
+                self.hits += 1
+                return entry
+            if self.store is None:
+                self.misses += 1
+                return None
+
+        # Read through to the persistent store outside the lock
+        try:
+            entry = self.store.get(key)
+        except sqlite3.Error as e:
+            self.store_errors += 1
+            logger.error(f"Cache store read error: {e}")
+            entry = None
+        if entry is not None:
+            # The stored size already accounts for the deflated copy
+            entry['deflated'] = deflate_result(entry['result'], entry['task_type'])
+            if self.on_prepare is not None:
+                self.on_prepare(entry)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.store_hits += 1
+            self._insert(key, entry)
+            return entry
+
+    def peek(self, key: str) -> Optional[Dict[str, Any]]:
+        """The live entry for key without touching LRU order, stats or the store"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires_at'] <= time.time():
+                return None
+            return entry
+
+    def set(self, key: str, result: Any, task_type: str,
+            prompt: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Store a result, evicting expired then least recently used entries.
+        The prompt, when given, is kept with it for the near-duplicate index
+        """
+        deflated = deflate_result(result, task_type)
+        size = _estimate_size(result) + CACHE_ENTRY_OVERHEAD + (len(deflated[0]) if deflated else 0)
+        if prompt:
+            size += len(prompt.encode('utf-8'))
+        if size > self.max_bytes:
+            logger.warning(f"Result too large to cache ({size} bytes)")
+            return None
+
+        entry = {
+            'result': result,
+            'timestamp': datetime.now().isoformat(),
+            'task_type': task_type,
+            'expires_at': time.time() + self.ttl_for(task_type),
+            'size': size,
+            'deflated': deflated,
+            'prompt': prompt
+        }
+        if self.on_prepare is not None:
+            self.on_prepare(entry)
+        with self._lock:
+            self._insert(key, entry)
+        if self.store is not None:
+            try:
+                self.store.set(key, entry)
+            except sqlite3.Error as e:
+                self.store_errors += 1
+                logger.error(f"Cache store write error: {e}")
+        return entry
+
+    def clear(self) -> bool:
+        """Empty both tiers; False if the persistent store could not be cleared"""
+        # Memory first, so a locked or broken store still leaves this process clean
+        with self._lock:
+            self._clear_memory()
+            self._hot_keys.clear()
+            self.hits = self.misses = self.store_hits = self.store_errors = 0
+            self.evictions = self.expirations = 0
+        if self.store is not None:
+            try:
+                self.store.clear()
+            except sqlite3.Error as e:
+                self.store_errors += 1
+                logger.error(f"Cache store clear error: {e}")
+                return False
+        return True
+
+    def invalidate(self, task_type: Optional[str] = None,
+                   key_prefix: Optional[str] = None) -> Dict[str, Any]:
+        """Drop entries of one task_type (or type family) and/or key prefix"""
+        removed_persistent = None
+        if self.store is not None:
+            try:
+                removed_persistent, generation = self.store.invalidate(task_type, key_prefix)
+                # Our own memory tier is handled below; don't drop all of it
+                self._store_generation = generation
+            except sqlite3.Error as e:
+                self.store_errors += 1
+                logger.error(f"Cache store invalidate error: {e}")
+        with self._lock:
+            doomed = [
+                key for key, entry in self._entries.items()
+                if self._matches(key, entry, task_type, key_prefix)
+            ]
+            for key in doomed:
+                self._remove(key)
+            self._publish_size()
+        return {'removed': len(doomed), 'removedPersistent': removed_persistent}
+
+    def recent(self, limit: int) -> List[tuple]:
+        """Most recently used (key, entry) pairs without copying the cache"""
+        return self.page(limit)[0]
+
+    def page(self, limit: int, task_type: Optional[str] = None,
+             key_prefix: Optional[str] = None,
+             after: Optional[str] = None) -> Tuple[List[tuple], Optional[str]]:
+        """
+        Up to `limit` matching (key, entry) pairs in most-recently-used order,
+        starting just past the key `after`, and the cursor for the next page
+        (None at the end). The walk starts at the cursor and looks at no more
+        than PAGE_SCAN_LIMIT entries, so the lock is held for a bounded time
+        even when few entries match; a short page then still has a cursor.
+        Raises KeyError when `after` has since left the cache
+        """
+        with self._lock:
+            if after is not None and after not in self._recency:
+                raise KeyError(after)
+            page, last = [], None
+            for scanned, key in enumerate(self._recency.older_than(after), 1):
+                last = key
+                entry = self._entries[key]
+                if self._matches(key, entry, task_type, key_prefix):
+                    page.append((key, entry))
+                if len(page) >= limit or scanned >= self.PAGE_SCAN_LIMIT:
+                    break
+            if last is None or next(self._recency.older_than(last), None) is None:
+                return page, None
+            return page, last
+
+    def count(self, task_type: Optional[str] = None) -> int:
+        """Entries in memory, in total or for one task_type family"""
+        with self._lock:
+            if task_type is None:
+                return len(self._entries)
+            return sum(
+                counts[0] for name, counts in self._by_type.items()
+                if task_type_matches(name, task_type)
+            )
+
+    def hot_keys(self, limit: int) -> List[Dict[str, Any]]:
+        """Most looked-up keys with estimated lookup counts, hits and misses alike"""
+        with self._lock:
+            hot = []
+            for key, count, error in self._hot_keys.top(limit):
+                entry = self._entries.get(key)
+                hot.append({
+                    'key': key,
+                    'lookups': count,
+                    'maxOvercount': error,
+                    'cached': entry is not None,
+                    'type': entry['task_type'] if entry is not None else None
+                })
+            return hot
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self._memory_stats()
+        if self.store is not None:
+            try:
+                stats['persistent'] = self.store.stats()
+            except sqlite3.Error as e:
+                stats['persistent'] = {'backend': 'sqlite', 'error': str(e)}
+        return stats
+
+    def _memory_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'cacheSize': len(self._entries),
+                'cacheBytes': self._bytes,
+                'maxEntries': self.max_entries,
+                'maxBytes': self.max_bytes,
+                'cacheHits': self.hits,
+                'cacheMisses': self.misses,
+                'storeHits': self.store_hits,
+                'storeErrors': self.store_errors,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hitRate': f"{(self.hits / lookups * 100):.1f}%" if lookups > 0 else "0%",
+                'byType': {
+                    task_type: {'entries': entries, 'bytes': size}
+                    for task_type, (entries, size) in self._by_type.items()
+                }
+            }
+
+    def _insert(self, key: str, entry: Dict[str, Any]):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._recency.append(key)
+        self._bytes += entry['size']
+        counts = self._by_type.setdefault(entry['task_type'], [0, 0])
+        counts[0] += 1
+        counts[1] += entry['size']
+        if self.on_insert is not None:
+            self.on_insert(key, entry)
+        heapq.heappush(self._expiry_heap, (entry['expires_at'], key))
+        self._purge_expired(time.time())
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(self._recency.oldest)
+            self.evictions += 1
+        self._publish_size()
+
+    def _clear_memory(self):
+        if self.on_remove is not None:
+            for key in self._entries:
+                self.on_remove(key)
+        self._entries.clear()
+        self._recency.clear()
+        self._expiry_heap = []
+        self._bytes = 0
+        self._by_type.clear()
+        self._publish_size()
+
+    def _publish_size(self):
+        CACHE_BYTES.set(self._bytes)
+        CACHE_ENTRIES.set(len(self._entries))
+
+    def _sync_store_generation(self):
+        """Drop the memory tier when another process cleared the shared store"""
+        if self.store is None:
+            return
+        try:
+            generation = self.store.generation()
+        except sqlite3.Error as e:
+            logger.error(f"Cache store read error: {e}")
+            return
+        if generation != self._store_generation:
+            with self._lock:
+                if self._store_generation is not None:
+                    self._clear_memory()
+                self._store_generation = generation
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._recency.remove(key)
+        self._bytes -= entry['size']
+        counts = self._by_type[entry['task_type']]
+        counts[0] -= 1
+        counts[1] -= entry['size']
+        if not counts[0]:
+            del self._by_type[entry['task_type']]
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+    @staticmethod
+    def _matches(key: str, entry: Dict[str, Any], task_type: Optional[str],
+                 key_prefix: Optional[str]) -> bool:
+        if task_type and not task_type_matches(entry['task_type'], task_type):
+            return False
+        return not key_prefix or key.startswith(key_prefix)
+
+    def _purge_expired(self, now: float):
+        # The heap may hold stale items for replaced or evicted keys; skip those
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, key = heapq.heappop(heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] == expires_at:
+                self._remove(key)
+                self.expirations += 1
+        if len(heap) > 2 * len(self._entries) + 64:
+            self._expiry_heap = [(e['expires_at'], k) for k, e in self._entries.items()]
+            heapq.heapify(self._expiry_heap)
+
+
+def result_field(task_type: str) -> str:
+    """Response field that carries a cached result ("content" for generations)"""
+    return 'content' if task_type.startswith('generate:') else 'result'
+
+def deflate_result(result: Any, task_type: str) -> Optional[Tuple[bytes, int, int]]:
+    """
+    Pre-compress the start of a response body, '{"result":<result>', as raw
+    deflate ending on a sync flush. The per-request remainder of the body is
+    deflated separately and appended, so a cache hit only compresses a few
+    dozen bytes. Returns (deflated, crc32, length) or None for small results
+    """
+    prefix = ('{' + json.dumps(result_field(task_type)) + ':'
+              + json.dumps(result, separators=(',', ':'))).encode('utf-8')
+    if len(prefix) < COMPRESS_MIN_BYTES:
+        return None
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(prefix) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return deflated, zlib.crc32(prefix), len(prefix)
+
+def _estimate_size(result: Any) -> int:
+    """Approximate the memory held by a cached result in bytes"""
+    if isinstance(result, str):
+        return len(result.encode('utf-8'))
+    return len(json.dumps(result, default=str).encode('utf-8'))
+
+
+cache = ResultCache(
+    CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_DEFAULT_TTL, CACHE_TASK_TTLS,
+    store=SQLiteCacheStore(CACHE_DB_PATH) if CACHE_DB_PATH else None,
+    hot_keys=CACHE_HOT_KEYS
+)
+
+near_duplicates = NearDuplicateIndex(NEAR_DUP_THRESHOLD) if NEAR_DUP_THRESHOLD > 0 else None
+if near_duplicates is not None:
+    cache.on_prepare = near_duplicates.prepare_entry
+    cache.on_insert = near_duplicates.add_entry
+    cache.on_remove = near_duplicates.remove
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls into a single execution
+
+    The first caller for a key (the leader) runs the function; callers that
+    arrive while it is in flight wait for the leader's result or exception
+    instead of starting their own CLI process. Streamed calls get the same
+    treatment through stream(): one producer, every subscriber sees all events.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+
+    class _Broadcast:
+        def __init__(self):
+            self.cond = threading.Condition()
+            self.events: List[Any] = []
+            self.done = False
+            self.error: Optional[BaseException] = None
+            self.subscribers = 0
+
+    class _Subscription:
+        """Iterator over a broadcast; close() (or reaching the end) unsubscribes"""
+
+        def __init__(self, flight: "SingleFlight", broadcast: "SingleFlight._Broadcast"):
+            self._flight = flight
+            self._broadcast = broadcast
+            self._seen = 0
+            self._closed = False
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            broadcast = self._broadcast
+            with broadcast.cond:
+                while self._seen == len(broadcast.events) and not broadcast.done and not self._closed:
+                    broadcast.cond.wait()
+                if self._seen < len(broadcast.events) and not self._closed:
+                    self._seen += 1
+                    return broadcast.events[self._seen - 1]
+            self.close()
+            if broadcast.error is not None:
+                raise broadcast.error
+            raise StopIteration
+
+        def close(self):
+            if not self._closed:
+                self._closed = True
+                with self._flight._lock:
+                    self._broadcast.subscribers -= 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, "SingleFlight._Call"] = {}
+        self._streams: Dict[str, "SingleFlight._Broadcast"] = {}
+        self.executions: Dict[str, int] = {}
+        self.coalesced: Dict[str, int] = {}
+
+    def do(self, key: str, fn: Callable[[], Any], source: str = 'default') -> Tuple[Any, bool]:
+        """Run fn once per in-flight key; returns (result, shared_with_leader)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+                self.executions[source] = self.executions.get(source, 0) + 1
+            else:
+                self.coalesced[source] = self.coalesced.get(source, 0) + 1
+                COALESCED.labels(source).inc()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stream(self, key: str, start: Callable[[], Iterator[Any]],
+               source: str = 'default') -> Tuple[Iterator[Any], bool]:
+        """
+        Subscribe to the in-flight stream for key, starting it if there is
+        none. Returns (events, shared_with_leader); every subscriber replays
+        the events produced so far and then follows live. The producer runs
+        on its own thread and is closed early once every subscriber has left.
+        """
+        with self._lock:
+            broadcast = self._streams.get(key)
+            leader = broadcast is None
+            if leader:
+                broadcast = self._streams[key] = SingleFlight._Broadcast()
+                self.executions[source] = self.executions.get(source, 0) + 1
+            else:
+                self.coalesced[source] = self.coalesced.get(source, 0) + 1
+                COALESCED.labels(source).inc()
+            broadcast.subscribers += 1
+
+        if leader:
+            threading.Thread(
+                target=self._pump, args=(key, broadcast, start), daemon=True
+            ).start()
+        return SingleFlight._Subscription(self, broadcast), not leader
+
+    def _pump(self, key: str, broadcast: "SingleFlight._Broadcast", start: Callable[[], Iterator[Any]]):
+        registered = True
+        events = None
+        try:
+            events = start()
+            for event in events:
+                with broadcast.cond:
+                    broadcast.events.append(event)
+                    broadcast.cond.notify_all()
+                with self._lock:
+                    if broadcast.subscribers == 0:
+                        # Nobody is listening; later requests start afresh
+                        del self._streams[key]
+                        registered = False
+                        broadcast.error = Exception("Stream abandoned by all subscribers")
+                        break
+        except BaseException as e:
+            broadcast.error = e
+        finally:
+            if events is not None:
+                # Closing the generator stops (and kills) an abandoned CLI run
+                events.close()
+            if registered:
+                with self._lock:
+                    del self._streams[key]
+            with broadcast.cond:
+                broadcast.done = True
+                broadcast.cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'inFlight': len(self._calls) + len(self._streams),
+                'executions': dict(self.executions),
+                'coalesced': dict(self.coalesced),
+                'coalescedTotal': sum(self.coalesced.values())
+            }
+
+class JobQueue:
+    """
+    Background job queue with priority tiers and per-business fairness
+
+    Each priority tier holds one FIFO per businessId and serves businesses
+    round-robin, so one tenant's burst cannot starve the others; workers
+    always drain higher tiers first. Finished jobs are kept for polling up
+    to `retention` and then dropped oldest first.
+    """
+
+    def __init__(self, handler: Callable[[str, Dict[str, Any]], Tuple[Dict[str, Any], int]],
+                 notifier: Callable[[Dict[str, Any]], Dict[str, Any]],
+                 workers: int, max_queued: int, retention: int):
+        self.handler = handler
+        self.notifier = notifier
+        self.workers = workers
+        self.max_queued = max_queued
+        self.retention = retention
+        self._tiers: List["OrderedDict[str, deque]"] = [OrderedDict() for _ in JOB_PRIORITIES]
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._finished: "OrderedDict[str, None]" = OrderedDict()
+        self._queued = 0
+        self._running = 0
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._callbacks = ThreadPoolExecutor(max_workers=2, thread_name_prefix='job-callback')
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, kind: str, payload: Dict[str, Any], business_id: str,
+               priority: str, callback_url: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Queue a job; returns None when the queue is full"""
+        self._ensure_started()
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'status': 'queued',
+            'priority': priority,
+            'businessId': business_id,
+            'payload': payload,
+            'callbackUrl': callback_url,
+            'submittedAt': datetime.now().isoformat()
+        }
+        with self._cond:
+            if self._queued >= self.max_queued:
+                return None
+            self._jobs[job['id']] = job
+            tier = self._tiers[JOB_PRIORITIES[priority]]
+            tier.setdefault(business_id, deque()).append(job)
+            self._queued += 1
+            self._cond.notify()
+        return self._public(job)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job is not None else None
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued job; running and finished jobs are left alone"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != 'queued':
+                return False
+            tier = self._tiers[JOB_PRIORITIES[job['priority']]]
+            pending = tier[job['businessId']]
+            pending.remove(job)
+            if not pending:
+                del tier[job['businessId']]
+            self._queued -= 1
+            self._finish(job, 'cancelled')
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'queued': self._queued,
+                'running': self._running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'workers': self.workers,
+                'tiers': {
+                    name: {
+                        'jobs': sum(len(pending) for pending in self._tiers[level].values()),
+                        'businesses': len(self._tiers[level])
+                    }
+                    for name, level in JOB_PRIORITIES.items()
+                }
+            }
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._cond:
+            if not self._threads:
+                for index in range(self.workers):
+                    thread = threading.Thread(target=self._work, name=f'job-{index}', daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _next(self) -> Dict[str, Any]:
+        """Block until a job is available; highest tier, next business in turn"""
+        with self._cond:
+            while self._queued == 0:
+                self._cond.wait()
+            for tier in self._tiers:
+                if tier:
+                    business_id, pending = next(iter(tier.items()))
+                    job = pending.popleft()
+                    del tier[business_id]
+                    if pending:
+                        tier[business_id] = pending  # back of the rotation
+                    self._queued -= 1
+                    self._running += 1
+                    job['status'] = 'running'
+                    job['startedAt'] = datetime.now().isoformat()
+                    return job
+        raise RuntimeError('Job queue accounting is inconsistent')
+
+    def _work(self):
+        while True:
+            job = self._next()
+            try:
+                body, status = self.handler(job['kind'], job['payload'])
+                job['result'] = body
+                job['httpStatus'] = status
+                # A task that raised comes back as a 200 fallback answer
+                if status >= 400 or body.get('fallback'):
+                    job['error'] = body.get('error', f'HTTP {status}')
+                    outcome = 'failed'
+                else:
+                    outcome = 'succeeded'
+            except Exception as e:
+                logger.error(f"Job {job['id']} failed: {e}")
+                job['error'] = str(e)
+                outcome = 'failed'
+            with self._cond:
+                self._running -= 1
+                self._finish(job, outcome)
+            if job['callbackUrl']:
+                self._callbacks.submit(self._notify, job)
+
+    def _notify(self, job: Dict[str, Any]):
+        delivery = self.notifier(self.get(job['id']) or self._public(job))
+        with self._cond:
+            job['callback'] = delivery
+
+    def _finish(self, job: Dict[str, Any], status: str):
+        job['status'] = status
+        job['finishedAt'] = datetime.now().isoformat()
+        if status == 'succeeded':
+            self.completed += 1
+        elif status == 'failed':
+            self.failed += 1
+        self._finished[job['id']] = None
+        while len(self._finished) > self.retention:
+            expired_id, _ = self._finished.popitem(last=False)
+            self._jobs.pop(expired_id, None)
+
+    @staticmethod
+    def _public(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in job.items() if key != 'payload'}
+
+class CLIWorkerPool:
+    """
+    Pool of pre-warmed Claude CLI worker processes
+
+    `claude --print` answers a single prompt per process, so a worker is a CLI
+    process that has already been forked, exec'd and booted and is blocked
+    reading its prompt from stdin. Checking one out takes process startup off
+    the request path. A background thread keeps `size` healthy spares for
+    each argument set in `prewarm` and recycles any that exited, outlived
+    `max_age` or grew past `max_rss_mb`; a worker is retired after serving its
+    one request. Other argument sets always get a cold spawn, so request input
+    can never grow the set of idle processes.
+    """
+
+    MAINTAIN_INTERVAL = 1.0
+
+    def __init__(self, command: str, size: int, max_age: float, max_rss_mb: int,
+                 prewarm: List[Tuple[str, ...]]):
+        self.command = command
+        self.size = size
+        self.max_age = max_age
+        self.max_rss_mb = max_rss_mb
+        self._spares: Dict[Tuple[str, ...], List[Tuple[subprocess.Popen, float]]] = {
+            args: [] for args in prewarm
+        }
+        self._active = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.warm_checkouts = 0
+        self.cold_spawns = 0
+        self.recycled = 0
+
+    def run(self, prompt: str, args: Tuple[str, ...], timeout: float) -> Tuple[int, str, str]:
+        """Send a prompt to a worker over stdin and wait for it to exit"""
+        proc = self.checkout(args)
+        try:
+            stdout, stderr = proc.communicate(input=prompt, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        except BaseException:
+            # The caller was interrupted, e.g. killed at the end of a shutdown
+            proc.kill()
+            raise
+        finally:
+            self.release(proc)
+        return proc.returncode, stdout, stderr
+
+    def run_hedged(self, prompt: str, args: Tuple[str, ...], timeout: float, hedge_after: float,
+                   may_hedge: Callable[[], bool]) -> Tuple[int, str, str, Optional[bool]]:
+        """
+        Like run, but if no answer has arrived after `hedge_after` seconds and
+        `may_hedge()` agrees, send the same prompt to a second worker. The first
+        successful answer wins and the other worker is killed. The last element
+        is None when no hedge was sent, otherwise whether the hedge won.
+        """
+        results = queue.Queue()
+        procs: List[subprocess.Popen] = []
+
+        def attempt(proc: subprocess.Popen, index: int):
+            try:
+                stdout, stderr = proc.communicate(input=prompt)
+                results.put((index, proc.returncode, stdout, stderr))
+            except (OSError, ValueError) as e:
+                results.put((index, -1, '', str(e)))
+            finally:
+                self.release(proc)
+
+        def launch():
+            proc = self.checkout(args)
+            procs.append(proc)
+            threading.Thread(target=attempt, args=(proc, len(procs) - 1), daemon=True).start()
+
+        started = time.monotonic()
+        deadline = started + timeout
+        hedge_at: Optional[float] = started + hedge_after
+        launch()
+        pending = 1
+        failure = None
+        try:
+            while pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise subprocess.TimeoutExpired(self.command, timeout)
+                wake = min(deadline, hedge_at) if hedge_at is not None else deadline
+                try:
+                    index, returncode, stdout, stderr = results.get(timeout=max(0.0, wake - now))
+                except queue.Empty:
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        hedge_at = None
+                        if may_hedge():
+                            launch()
+                            pending += 1
+                    continue
+                pending -= 1
+                hedge_won = index == 1 if len(procs) > 1 else None
+                if returncode == 0:
+                    return returncode, stdout, stderr, hedge_won
+                # A failed attempt only decides the call if nothing else is running
+                failure = (returncode, stdout, stderr, hedge_won)
+            return failure
+        finally:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+
+    def checkout(self, args: Tuple[str, ...]) -> subprocess.Popen:
+        """Take a healthy pre-warmed worker, or spawn one if none is ready"""
+        self._ensure_started()
+        with self._lock:
+            spares = self._spares.get(args, [])
+            while spares:
+                proc, started = spares.pop()
+                if self._healthy(proc, started):
+                    self.warm_checkouts += 1
+                    self._active.add(proc)
+                    self._wakeup.set()
+                    return proc
+                self._retire(proc)
+            self.cold_spawns += 1
+        self._wakeup.set()
+        proc = self._spawn(args, 'cold')
+        with self._lock:
+            self._active.add(proc)
+        return proc
+
+    def release(self, proc: subprocess.Popen):
+        """Mark a checked-out worker as finished"""
+        with self._lock:
+            self._active.discard(proc)
+            if not self._active:
+                self._idle.notify_all()
+
+    def drain(self, timeout: float) -> int:
+        """
+        Stop pre-warming, then wait up to `timeout` seconds for checked-out
+        workers to finish; any still running are killed. Returns how many were
+        """
+        self.shutdown()
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            leftover = list(self._active)
+        for proc in leftover:
+            if proc.poll() is None:
+                proc.kill()
+        return len(leftover)
+
+    def shutdown(self):
+        self._closed = True
+        self._wakeup.set()
+        with self._lock:
+            for spares in self._spares.values():
+                for proc, _ in spares:
+                    self._retire(proc)
+            for args in self._spares:
+                self._spares[args] = []
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'size': self.size,
+                'spares': sum(len(spares) for spares in self._spares.values()),
+                'active': len(self._active),
+                'warmCheckouts': self.warm_checkouts,
+                'coldSpawns': self.cold_spawns,
+                'recycled': self.recycled
+            }
+
+    def _spawn(self, args: Tuple[str, ...], path: str) -> subprocess.Popen:
+        with SPAWN_SECONDS.labels(path).time():
+            return subprocess.Popen(
+                [self.command, *args],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                encoding='utf-8'
+            )
+
+    def _ensure_started(self):
+        if self._thread is None and self.size > 0 and not self._closed:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._maintain, name='cli-pool', daemon=True
+                    )
+                    self._thread.start()
+
+    def _maintain(self):
+        while not self._closed:
+            with self._lock:
+                keys = list(self._spares)
+                for args in keys:
+                    spares = self._spares[args]
+                    healthy = []
+                    for proc, started in spares:
+                        if self._healthy(proc, started):
+                            healthy.append((proc, started))
+                        else:
+                            self._retire(proc)
+                    self._spares[args] = healthy
+            for args in keys:
+                # Spawn outside the lock; fork+exec is the slow part
+                while not self._closed:
+                    with self._lock:
+                        if len(self._spares[args]) >= self.size:
+                            break
+                    try:
+                        proc = self._spawn(args, 'prewarm')
+                    except OSError as e:
+                        logger.warning(f"Could not pre-warm Claude CLI worker: {e}")
+                        break
+                    with self._lock:
+                        self._spares[args].append((proc, time.monotonic()))
+            self._wakeup.wait(self.MAINTAIN_INTERVAL)
+            self._wakeup.clear()
+
+    def _healthy(self, proc: subprocess.Popen, started: float) -> bool:
+        if proc.poll() is not None:
+            return False
+        if time.monotonic() - started > self.max_age:
+            return False
+        return _process_rss_mb(proc.pid) <= self.max_rss_mb
+
+    def _retire(self, proc: subprocess.Popen):
+        self.recycled += 1
+        if proc.poll() is None:
+            proc.kill()
+        try:
+            proc.communicate(timeout=1)
+        except (subprocess.TimeoutExpired, OSError, ValueError):
+            pass
+
+
+def _process_rss_mb(pid: int) -> float:
+    """Resident set size of a process in MB (0 where /proc is unavailable)"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class MicroBatcher:
+    """
+    Answer short prompts that arrive within a small window with one CLI call
+
+    Prompts are combined into one numbered multi-question prompt that asks
+    for a JSON array of answers. If the reply cannot be split into exactly
+    one answer per question, each prompt falls back to its own query. A batch
+    is flushed when the window closes or it reaches `max_size` prompts.
+
+    Batches never mix groups (one business, or one bulk request): questions
+    share a prompt and a reply, so one tenant's text could otherwise be read
+    or steered by another's.
+    """
+
+    def __init__(self, query_fn: Callable[[str], str], window: float, max_size: int):
+        self.query_fn = query_fn
+        self.window = window
+        self.max_size = max_size
+        self._pending: Dict[str, List[Tuple[str, Future]]] = {}  # group -> open batch
+        self._lock = threading.Lock()
+        self._fallback_executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix='batch-fallback')
+        self.batches = 0
+        self.batched_prompts = 0
+        self.split_failures = 0
+
+    def query(self, prompt: str, group: str) -> str:
+        """Queue a prompt for its group's current batch and wait for its answer"""
+        future: Future = Future()
+        batch = None
+        with self._lock:
+            pending = self._pending.setdefault(group, [])
+            pending.append((prompt, future))
+            if len(pending) >= self.max_size:
+                batch = self._take(group)
+            elif len(pending) == 1:
+                timer = threading.Timer(self.window, self._flush, args=(group, pending))
+                timer.daemon = True
+                timer.start()
+        if batch:
+            # The request that filled the batch runs it
+            self._run(batch)
+        return future.result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'windowMs': self.window * 1000,
+                'maxSize': self.max_size,
+                'pending': sum(len(pending) for pending in self._pending.values()),
+                'batches': self.batches,
+                'batchedPrompts': self.batched_prompts,
+                'splitFailures': self.split_failures
+            }
+
+    def _take(self, group: str) -> List[Tuple[str, Future]]:
+        return self._pending.pop(group)
+
+    def _flush(self, group: str, batch: List[Tuple[str, Future]]):
+        with self._lock:
+            # A batch that already filled up has been taken by its last caller
+            if self._pending.get(group) is not batch:
+                return
+            self._take(group)
+        self._run(batch)
+
+    def _run(self, batch: List[Tuple[str, Future]]):
+        if len(batch) == 1:
+            self._run_single(*batch[0])
+            return
+
+        answers = None
+        try:
+            reply = self.query_fn(build_batch_prompt([prompt for prompt, _ in batch]))
+            answers = split_batch_reply(reply, len(batch))
+        except Exception as e:
+            logger.warning(f"Batched query failed, falling back to single calls: {e}")
+
+        with self._lock:
+            self.batches += 1
+            if answers is None:
+                self.split_failures += 1
+            else:
+                self.batched_prompts += len(batch)
+
+        if answers is None:
+            for prompt, future in batch:
+                self._fallback_executor.submit(self._run_single, prompt, future)
+            return
+        for (_, future), answer in zip(batch, answers):
+            future.set_result(answer)
+
+    def _run_single(self, prompt: str, future: Future):
+        try:
+            future.set_result(self.query_fn(prompt))
+        except Exception as e:
+            future.set_exception(e)
+
+
+def build_batch_prompt(prompts: List[str]) -> str:
+    """Combine independent questions into one prompt with a JSON array reply"""
+    questions = '\n\n'.join(
+        f"Question {index}:\n{prompt}" for index, prompt in enumerate(prompts, start=1)
+    )
+    return (
+        f"Answer each of the following {len(prompts)} independent questions separately. "
+        f"Reply with only a JSON array of exactly {len(prompts)} strings, where element i is "
+        f"the complete answer to question i. Do not add any other text.\n\n{questions}"
+    )
+
+
+def split_batch_reply(reply: str, expected: int) -> Optional[List[str]]:
+    """Per-question answers from a batched reply, or None if it is ambiguous"""
+    start, end = reply.find('['), reply.rfind(']')
+    if start == -1 or end <= start:
+        return None
+    try:
+        answers = json.loads(reply[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(answers, list) or len(answers) != expected:
+        return None
+    if not all(isinstance(answer, str) and answer.strip() for answer in answers):
+        return None
+    return [answer.strip() for answer in answers]
+
+
+class CLIUnavailableError(Exception):
+    """Raised instead of calling the CLI when it is overloaded or failing"""
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on concurrent CLI calls
+
+    Latency is tracked by two moving averages: a short one over the last ten
+    or so calls and a baseline over about `BASELINE_WINDOW` seconds (a plain
+    mean over the first `WARMUP_CALLS`). The baseline is a mean, not a
+    minimum, so ordinary spread in CLI latency is not mistaken for congestion,
+    and it decays by time rather than per call, so a higher limit (more calls
+    per second) cannot drag it up as fast as latency rises. The limit is cut
+    by `backoff` when the short average climbs past `tolerance` times the
+    baseline or a call times out. While healthy and in use it grows by one per
+    call while callers are queued and nothing has been cut yet (slow start,
+    doubling per round), and by about one per round after that. Callers over
+    the limit wait in a queue of at most `max_queue` for up to
+    `queue_timeout` seconds before being rejected.
+    """
+
+    EWMA_ALPHA = 0.2
+    BASELINE_WINDOW = 60.0  # seconds
+    WARMUP_CALLS = 20  # plain mean, and no latency cuts, until this many calls
+    DECREASE_INTERVAL = 1.0  # at most one cut per second, one incident is one signal
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int, max_queue: int,
+                 queue_timeout: float, tolerance: float, backoff: float = 0.75):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self._in_flight = 0
+        self._waiting = 0
+        self._baseline: Optional[float] = None
+        self._smoothed: Optional[float] = None
+        self._baseline_at = 0.0
+        self._calls = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self.rejected = 0
+        CONCURRENCY_LIMIT.set(self.limit)
+
+    def acquire(self):
+        """Wait for a slot, raising CLIUnavailableError if the queue is full or too slow"""
+        with self._cond:
+            if self._in_flight >= int(self.limit):
+                if self._waiting >= self.max_queue:
+                    self._reject('queue_full')
+                deadline = time.monotonic() + self.queue_timeout
+                self._waiting += 1
+                try:
+                    while self._in_flight >= int(self.limit):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject('queue_timeout')
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_flight += 1
+
+    def release(self, latency: float, outcome: str):
+        """Return a slot and adjust the limit from the call's latency and outcome"""
+        with self._cond:
+            saturated = self._in_flight >= int(self.limit) * 0.5
+            self._in_flight -= 1
+            if outcome == 'timeout':
+                self._decrease()
+            elif outcome == 'ok':
+                now = time.monotonic()
+                self._calls += 1
+                if self._smoothed is None:
+                    self._smoothed = self._baseline = latency
+                else:
+                    self._smoothed += self.EWMA_ALPHA * (latency - self._smoothed)
+                    if self._calls <= self.WARMUP_CALLS:
+                        weight = 1 / self._calls
+                    else:
+                        weight = 1 - math.exp(-(now - self._baseline_at) / self.BASELINE_WINDOW)
+                    self._baseline += weight * (latency - self._baseline)
+                self._baseline_at = now
+                if self._calls > self.WARMUP_CALLS and self._smoothed > self._baseline * self.tolerance:
+                    self._decrease()
+                elif saturated and self.limit < self.max_limit:
+                    # Only grow a limit that is actually being used
+                    # Slow start: double per round while callers queue, until the first cut
+                    step = 1 if self._waiting and not self._last_decrease else 1 / self.limit
+                    self.limit = min(self.max_limit, self.limit + step)
+                    CONCURRENCY_LIMIT.set(self.limit)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'limit': round(self.limit, 2),
+                'inFlight': self._in_flight,
+                'waiting': self._waiting,
+                'rejected': self.rejected,
+                'baselineSeconds': round(self._baseline, 3) if self._baseline is not None else None,
+                'smoothedSeconds': round(self._smoothed, 3) if self._smoothed is not None else None
+            }
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.DECREASE_INTERVAL:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        CONCURRENCY_LIMIT.set(self.limit)
+        logger.warning(f"Claude CLI latency rising, concurrency limit lowered to {self.limit:.1f}")
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        LOAD_SHED.labels(reason).inc()
+        raise CLIUnavailableError("Server busy - too many Claude requests in progress")
+
+
+class HedgePolicy:
+    """
+    Decide when a query should be hedged and whether the budget allows it
+
+    The hedge delay is the `percentile` of the last `window` successful query
+    latencies (no hedging until `min_samples` are known). Every query earns
+    `budget` tokens, capped at 10, and a hedge spends one, so hedges stay at
+    about `budget` of queries however slow the CLI gets.
+    """
+
+    MAX_TOKENS = 10.0
+
+    def __init__(self, percentile: float, budget: float, window: int, min_samples: int):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.denied = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        """Count a new query and return how long it may run before hedging"""
+        with self._lock:
+            self.queries += 1
+            self._tokens = min(self.MAX_TOKENS, self._tokens + self.budget)
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return ordered[index]
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.hedges += 1
+                return True
+            self.denied += 1
+        HEDGES_DENIED.inc()
+        return False
+
+    def observe(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def record_hedge(self, hedge_won: bool):
+        with self._lock:
+            if hedge_won:
+                self.hedge_wins += 1
+        HEDGES.labels('hedge' if hedge_won else 'primary').inc()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            ordered = sorted(self._latencies)
+            index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+            return {
+                'percentile': self.percentile,
+                'delaySeconds': round(ordered[index], 3) if len(ordered) >= self.min_samples else None,
+                'queries': self.queries,
+                'hedges': self.hedges,
+                'hedgeWins': self.hedge_wins,
+                'denied': self.denied,
+                'hedgeRate': round(self.hedges / self.queries, 4) if self.queries else 0.0
+            }
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the CLI is erroring or timing out
+
+    Closed: calls pass and outcomes are tracked over the last `window` calls;
+    reaching `failure_rate` (after `min_calls`) opens the circuit. Open: calls
+    are rejected immediately while a background thread runs `probe` every
+    `cooldown` seconds. Half-open: after a successful probe, `half_open_calls`
+    real calls are let through; if all succeed the circuit closes, any failure
+    opens it again.
+    """
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, probe: Callable[[], bool], window: int, min_calls: int,
+                 failure_rate: float, cooldown: float, half_open_calls: int):
+        self.probe = probe
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+        self.half_open_calls = max(1, half_open_calls)
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._trials = 0
+        self._trial_successes = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.trips = 0
+        self.rejected = 0
+        CIRCUIT_STATE.set(0)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                return True
+            self.rejected += 1
+        LOAD_SHED.labels('circuit_open').inc()
+        return False
+
+    def record(self, success: Optional[bool]):
+        """Record a call's outcome; None means it ended without a verdict (e.g. cancelled)"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if success is None:
+                    self._trials -= 1
+                elif not success:
+                    self._open()
+                else:
+                    self._trial_successes += 1
+                    if self._trial_successes >= self.half_open_calls:
+                        self._set_state(self.CLOSED)
+                        logger.info("Claude CLI recovered, circuit closed")
+            elif self.state == self.CLOSED and success is not None:
+                self._outcomes.append(success)
+                failures = self._outcomes.count(False)
+                if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                    self._open()
+            # Results of calls admitted before the circuit opened are ignored
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self.state,
+                'recentFailures': self._outcomes.count(False),
+                'recentCalls': len(self._outcomes),
+                'trips': self.trips,
+                'rejected': self.rejected,
+                'openForSeconds': round(time.monotonic() - self._opened_at, 1) if self._opened_at else None
+            }
+
+    def _set_state(self, state: str):
+        self.state = state
+        self._outcomes.clear()
+        self._trials = 0
+        self._trial_successes = 0
+        self._opened_at = time.monotonic() if state == self.OPEN else None
+        CIRCUIT_STATE.set(self.STATE_VALUES[state])
+
+    def _open(self):
+        self._set_state(self.OPEN)
+        self.trips += 1
+        logger.error(f"Claude CLI failing, circuit opened; probing every {self.cooldown:.0f}s")
+        threading.Thread(target=self._probe_until_recovered, name='cli-probe', daemon=True).start()
+
+    def _probe_until_recovered(self):
+        while True:
+            time.sleep(self.cooldown)
+            try:
+                healthy = self.probe()
+            except Exception as e:
+                logger.warning(f"Claude CLI probe failed: {e}")
+                healthy = False
+            with self._lock:
+                if self.state != self.OPEN:
+                    return
+                if healthy:
+                    self._set_state(self.HALF_OPEN)
+                    logger.info("Claude CLI probe succeeded, circuit half-open")
+                    return
+
+
+class ClaudeCodeService:
+    """Service for interacting with Claude Code CLI"""
+    
+    # stream-json with partial messages emits text deltas as they are generated
+    STREAM_ARGS = ('--print', '--output-format', 'stream-json', '--verbose', '--include-partial-messages')
+    OUTPUT_FORMATS = ('text', 'json')
+    
+    @staticmethod
+    def query(prompt: str, output_format: str = "text") -> str:
+        """
+        Execute a Claude Code query using the CLI in non-interactive mode
+        """
+        ClaudeCodeService._admit()
+        started = time.perf_counter()
+        outcome = 'error'
+        CLI_IN_FLIGHT.inc()
+        try:
+            # The prompt goes to a pre-warmed worker over stdin, no shell involved
+            args = ('--print', '--output-format', output_format)
+            hedge_after = hedge_policy.hedge_delay() if hedge_policy else None
+            if hedge_after is None:
+                returncode, stdout, stderr = cli_pool.run(prompt, args, CLI_TIMEOUT)
+            else:
+                # Slow calls get a second, identical invocation; the first answer wins
+                returncode, stdout, stderr, hedge_won = cli_pool.run_hedged(
+                    prompt, args, CLI_TIMEOUT, hedge_after, hedge_policy.try_spend
+                )
+                if hedge_won is not None:
+                    hedge_policy.record_hedge(hedge_won)
+            
+            if returncode == 0:
+                outcome = 'ok'
+                if hedge_policy:
+                    hedge_policy.observe(time.perf_counter() - started)
+                return stdout.strip()
+            else:
+                error_msg = stderr.strip() if stderr else "Unknown error"
+                logger.error(f"Claude CLI error: {error_msg}")
+                raise Exception(f"Claude CLI error: {error_msg}")
+                
+        except subprocess.TimeoutExpired:
+            outcome = 'timeout'
+            CLI_TIMEOUTS.labels('query').inc()
+            logger.error("Claude CLI query timeout")
+            raise Exception("Query timeout - Claude took too long to respond")
+        except Exception as e:
+            logger.error(f"Error executing Claude query: {e}")
+            raise
+        finally:
+            CLI_IN_FLIGHT.dec()
+            ClaudeCodeService._finish(time.perf_counter() - started, outcome)
+            CLI_SECONDS.labels('query', outcome).observe(time.perf_counter() - started)
+
+    @staticmethod
+    def stream(prompt: str) -> Iterator[Tuple[str, str]]:
+        """
+        Execute a Claude Code query and yield ('delta', text) chunks as the CLI
+        writes them, followed by a single ('result', full_text)
+        """
+        ClaudeCodeService._admit()
+        try:
+            proc = cli_pool.checkout(ClaudeCodeService.STREAM_ARGS)
+        except BaseException:
+            ClaudeCodeService._finish(0.0, 'cancelled')
+            raise
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            proc.kill()
+
+        watchdog = threading.Timer(CLI_TIMEOUT, on_timeout)
+        watchdog.start()
+        chunks = []
+        result = None
+        started = time.perf_counter()
+        outcome = 'error'
+        CLI_IN_FLIGHT.inc()
+        try:
+            proc.stdin.write(prompt)
+            proc.stdin.close()
+            for line in proc.stdout:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Plain text output; pass it through as-is
+                    chunks.append(line + '\n')
+                    yield 'delta', line + '\n'
+                    continue
+                if event.get('type') == 'stream_event':
+                    delta = event.get('event', {}).get('delta', {})
+                    if delta.get('type') == 'text_delta' and delta.get('text'):
+                        chunks.append(delta['text'])
+                        yield 'delta', delta['text']
+                elif event.get('type') == 'result':
+                    if event.get('is_error'):
+                        raise Exception(f"Claude CLI error: {event.get('result')}")
+                    result = event.get('result')
+
+            stderr = proc.stderr.read()
+            if proc.wait() != 0:
+                if timed_out.is_set():
+                    outcome = 'timeout'
+                    CLI_TIMEOUTS.labels('stream').inc()
+                    logger.error("Claude CLI query timeout")
+                    raise Exception("Query timeout - Claude took too long to respond")
+                error_msg = stderr.strip() if stderr else "Unknown error"
+                logger.error(f"Claude CLI error: {error_msg}")
+                raise Exception(f"Claude CLI error: {error_msg}")
+            outcome = 'ok'
+        except GeneratorExit:
+            # The client went away; says nothing about the CLI's health
+            outcome = 'cancelled'
+            raise
+        finally:
+            # Also runs when the client disconnects mid-stream
+            watchdog.cancel()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            cli_pool.release(proc)
+            CLI_IN_FLIGHT.dec()
+            ClaudeCodeService._finish(time.perf_counter() - started, outcome)
+            CLI_SECONDS.labels('stream', outcome).observe(time.perf_counter() - started)
+
+        yield 'result', (result if result is not None else ''.join(chunks)).strip()
+
+    @staticmethod
+    def _admit():
+        """Fail fast while the circuit is open, otherwise wait for a concurrency slot"""
+        if not circuit_breaker.allow():
+            raise CLIUnavailableError("Claude CLI is unavailable - serving fallback until it recovers")
+        try:
+            concurrency_limiter.acquire()
+        except CLIUnavailableError:
+            circuit_breaker.record(None)
+            raise
+
+    @staticmethod
+    def _finish(latency: float, outcome: str):
+        concurrency_limiter.release(latency, outcome)
+        circuit_breaker.record(None if outcome == 'cancelled' else outcome == 'ok')
+
+    @staticmethod
+    def probe() -> bool:
+        """Cheap health check that bypasses the limiter and breaker"""
+        returncode, stdout, _ = cli_pool.run(
+            "Reply with OK", ('--print', '--output-format', 'text'), CLI_TIMEOUT
+        )
+        return returncode == 0 and bool(stdout.strip())
+
+    @staticmethod
+    def get_generation_cache_key(content_type: str, output_format: str, context: Any) -> str:
+        """Generate a cache key for /api/generate from its canonical inputs"""
+        content = f"generate:{content_type}:{output_format}:{canonical_json(context)}"
+        return hashlib.md5(content.encode()).hexdigest()
+
+    @staticmethod
+    def get_cache_key(prompt: str, task_type: str = "") -> str:
+        """Generate a cache key for the canonicalized prompt"""
+        content = f"{str(task_type or 'general').lower()}:{canonicalize_prompt(prompt)}"
+        return hashlib.md5(content.encode()).hexdigest()
+
+# Initialize service
+cli_pool = CLIWorkerPool(
+    CLAUDE_BIN, CLI_POOL_SIZE, CLI_WORKER_MAX_AGE, CLI_WORKER_MAX_RSS_MB,
+    prewarm=[('--print', '--output-format', fmt) for fmt in ClaudeCodeService.OUTPUT_FORMATS]
+    + [ClaudeCodeService.STREAM_ARGS]
+)
+atexit.register(cli_pool.shutdown)
+claude_service = ClaudeCodeService()
+
+# Bounds concurrent CLI calls and fails fast while the CLI is unhealthy
+concurrency_limiter = AdaptiveConcurrencyLimiter(
+    CONCURRENCY_INITIAL, CONCURRENCY_MIN, CONCURRENCY_MAX, CONCURRENCY_QUEUE,
+    CONCURRENCY_QUEUE_TIMEOUT, CONCURRENCY_TOLERANCE
+)
+circuit_breaker = CircuitBreaker(
+    claude_service.probe, BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATE,
+    BREAKER_COOLDOWN, BREAKER_HALF_OPEN_CALLS
+)
+
+# Hedges slow queries when CLAUDE_HEDGE_PERCENTILE is set (streams are never hedged)
+hedge_policy = HedgePolicy(
+    HEDGE_PERCENTILE, HEDGE_BUDGET, HEDGE_WINDOW, HEDGE_MIN_SAMPLES
+) if HEDGE_PERCENTILE > 0 else None
+
+# Batches short prompts into one CLI call when CLAUDE_BATCH_WINDOW_MS is set
+micro_batcher = MicroBatcher(
+    claude_service.query, BATCH_WINDOW_MS / 1000, BATCH_MAX_SIZE
+) if BATCH_WINDOW_MS > 0 else None
+
+# Coalesces identical in-flight queries across /api/task, bulk and generate
+single_flight = SingleFlight()
+
+# Shared, bounded pool for bulk requests so concurrent bulk calls cannot
+# spawn more CLI processes than BULK_MAX_WORKERS
+bulk_executor = ThreadPoolExecutor(max_workers=BULK_MAX_WORKERS, thread_name_prefix='bulk')
+
+# Background jobs run the same code paths as the synchronous endpoints
+job_queue = JobQueue(
+    handler=lambda kind, payload: JOB_RUNNERS[kind](payload),
+    notifier=lambda job: deliver_job_callback(job),
+    workers=JOB_WORKERS,
+    max_queued=JOB_MAX_QUEUED,
+    retention=JOB_RETENTION
+)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.endpoint or 'unknown'
+    g.metrics_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.labels(g.metrics_endpoint).inc()
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    # Streamed responses are recorded by stream_response once the stream ends
+    if g.get('metrics_streaming'):
+        return
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        observe_request(g.metrics_endpoint, started)
+
+def observe_request(endpoint: str, started: float):
+    REQUESTS_IN_FLIGHT.labels(endpoint).dec()
+    REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, aggregated across processes in multiprocess mode"""
+    registry = REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint"""
+    return jsonify({
+        'status': 'healthy',
+        'service': 'Claude Code API Server',
+        'cliPool': cli_pool.stats(),
+        'concurrency': concurrency_limiter.stats(),
+        'circuit': circuit_breaker.stats(),
+        'hedging': hedge_policy.stats() if hedge_policy else None,
+        'batching': micro_batcher.stats() if micro_batcher else None,
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/api/task', methods=['POST'])
+def process_task():
+    """
+    Process a business task using Claude Code
+    
+    Expected JSON payload:
+    {
+        "businessId": "biz-001",
+        "content": "Task description",
+        "type": "financial|marketing|strategy|operations|general",
+        "useCache": true,
+        "allowSimilar": true,
+        "stream": false,
+        "streamFormat": "sse|ndjson"
+    }
+
+    Cached answers carry a "similarity" score: 1.0 for an exact (canonical)
+    match, lower when a near-duplicate prompt's answer was reused.
+
+    With "stream" (or an Accept header of text/event-stream or
+    application/x-ndjson) the CLI output is sent incrementally as start,
+    delta and done events; the full result is still cached at the end.
+    """
+    data = request.json
+    if not data or 'content' not in data:
+        return jsonify({'error': 'Missing content in request'}), 400
+    
+    stream_format = requested_stream_format(data)
+    if stream_format:
+        return stream_task(data, stream_format)
+    
+    payload, status = run_task(data)
+    return result_response(payload, status, 'result')
+
+@app.route('/api/bulk-task', methods=['POST'])
+def process_bulk_tasks():
+    """
+    Process multiple tasks across different businesses
+    
+    Expected JSON payload:
+    {
+        "businessIds": ["biz-001", "biz-002"],
+        "content": "Task description",
+        "type": "general",
+        "tasks": [{"businessId": "biz-003", "content": "...", "type": "..."}],
+        "timeoutSeconds": 60
+    }
+
+    Entries in the optional "tasks" list override content/type per business.
+    Each unique prompt is sent to the bulk worker pool once and its result is
+    fanned out to every business that asked for it. Prompts still running when
+    the deadline passes are reported as failed for their businesses.
+    """
+    payload, status = run_bulk(request.json or {})
+    return jsonify(payload), status
+
+@app.route('/api/generate', methods=['POST'])
+def generate_content():
+    """
+    Generate specific content using Claude Code
+    
+    Expected JSON payload:
+    {
+        "type": "marketing|email|report|code",
+        "context": {...},
+        "format": "text|json",
+        "useCache": true,
+        "stream": false
+    }
+
+    Results are cached by type, format (both case-insensitive) and a
+    canonical serialization of context, so key order does not cause misses. JSON
+    results are cached already parsed. Streaming works as for /api/task;
+    with format "json" the final content is parsed once the stream completes.
+    """
+    data = request.json
+    stream_format = requested_stream_format(data or {})
+    if stream_format:
+        try:
+            return stream_generate(data, stream_format)
+        except Exception as e:
+            logger.error(f"Error generating content: {e}")
+            return jsonify({'error': str(e)}), 500
+    
+    payload, status = run_generate(data)
+    return result_response(payload, status, 'content')
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """
+    Submit a task, bulk task or generation as a background job
+    
+    Expected JSON payload:
+    {
+        "kind": "task|bulk|generate",
+        "payload": {...same body as /api/task, /api/bulk-task or /api/generate...},
+        "priority": "interactive|normal|bulk",
+        "callbackUrl": "http://localhost:8080/hooks/claude"
+    }
+
+    Returns 202 with a job ID immediately; poll /api/jobs/<id> or pass a
+    local callbackUrl to receive the finished job as a POST.
+    """
+    data = request.json or {}
+    kind = data.get('kind', 'task')
+    payload = data.get('payload')
+    if kind not in JOB_RUNNERS:
+        return jsonify({'error': f"Unknown job kind: {kind}"}), 400
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'Missing payload in request'}), 400
+    invalid = validate_job_payload(kind, payload)
+    if invalid:
+        return jsonify({'error': invalid}), 400
+    
+    priority = data.get('priority', 'bulk' if kind == 'bulk' else 'interactive')
+    if priority not in JOB_PRIORITIES:
+        return jsonify({'error': f"Unknown priority: {priority}"}), 400
+    
+    callback_url = data.get('callbackUrl')
+    if callback_url and not is_local_url(callback_url):
+        return jsonify({'error': 'callbackUrl must point to localhost'}), 400
+    
+    # Bulk jobs are scheduled under their first business
+    business_id = data.get('businessId') or payload.get('businessId') \
+        or next(iter(payload.get('businessIds') or []), 'unknown')
+    job = job_queue.submit(kind, payload, business_id, priority, callback_url)
+    if job is None:
+        return jsonify({'error': 'Job queue is full'}), 429
+    
+    return jsonify({
+        'success': True,
+        'jobId': job['id'],
+        'status': job['status'],
+        'statusUrl': f"/api/jobs/{job['id']}"
+    }), 202
 
-# Simple in-memory cache
-cache = {}
-cache_hits = 0
-cache_misses = 0
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str):
+    """Poll a background job's status and result"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
 
-class ClaudeCodeService:
-    """Service for interacting with Claude Code CLI"""
-    
-    @staticmethod
-    def query(prompt: str, output_format: str = "text") -> str:
-        """
-        Execute a Claude Code query using the CLI in non-interactive mode
-        """
-        try:
-            # Use echo to pipe the prompt to claude with --print flag
-            # Escape quotes in the prompt
-            escaped_prompt = prompt.replace('"', '\\"').replace("'", "\\'")
-            cmd = f'echo "{escaped_prompt}" | claude --print --output-format {output_format}'
-            
-            result = subprocess.run(
-                cmd,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
-            
-            if result.returncode == 0:
-                return result.stdout.strip()
-            else:
-                error_msg = result.stderr.strip() if result.stderr else "Unknown error"
-                logger.error(f"Claude CLI error: {error_msg}")
-                raise Exception(f"Claude CLI error: {error_msg}")
-                
-        except subprocess.TimeoutExpired:
-            logger.error("Claude CLI query timeout")
-            raise Exception("Query timeout - Claude took too long to respond")
-        except Exception as e:
-            logger.error(f"Error executing Claude query: {e}")
-            raise
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id: str):
+    """Cancel a job that has not started running yet"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not job_queue.cancel(job_id):
+        return jsonify({'error': f"Job is already {job['status']}"}), 409
+    return jsonify({'success': True, 'jobId': job_id, 'status': 'cancelled'})
 
-    @staticmethod
-    def get_cache_key(prompt: str, task_type: str = "") -> str:
-        """Generate a cache key for the prompt"""
-        content = f"{task_type}:{prompt}".lower()
-        return hashlib.md5(content.encode()).hexdigest()
+@app.route('/api/jobs', methods=['GET'])
+def job_stats():
+    """Queue depth per priority tier and job counts"""
+    return jsonify(job_queue.stats())
 
-# Initialize service
-claude_service = ClaudeCodeService()
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Get cache statistics"""
+    stats = cache.stats()
+    stats['entries'] = [
+        {
+            'key': key,
+            'timestamp': value['timestamp'],
+            'type': value['task_type']
+        }
+        for key, value in cache.recent(10)  # Show last 10 entries
+    ]
+    stats['hotKeys'] = cache.hot_keys(10)
+    stats['coalescing'] = single_flight.stats()
+    return jsonify(stats)
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint"""
+@app.route('/api/cache/entries', methods=['GET'])
+def cache_entries():
+    """
+    Page through cached entries, most recently used first
+    
+    Query parameters: after (the nextCursor of the previous page), limit
+    (default 50, max 500), type (task_type or family such as "generate"),
+    prefix (cache key prefix). A filtered page may come back short with a
+    cursor; keep following nextCursor until it is null. Entries used while
+    paging move to the front and can be missed or repeated
+    """
+    try:
+        limit = min(500, max(1, int(request.args.get('limit', 50))))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    task_type = request.args.get('type') or None
+    key_prefix = request.args.get('prefix') or None
+    after = request.args.get('after') or None
+    
+    now = time.time()
+    try:
+        page, next_cursor = cache.page(limit, task_type, key_prefix, after)
+    except KeyError:
+        return jsonify({'error': 'Cursor is no longer in the cache; start again without after'}), 410
     return jsonify({
-        'status': 'healthy',
-        'service': 'Claude Code API Server',
-        'timestamp': datetime.now().isoformat()
+        'entries': [
+            {
+                'key': key,
+                'type': entry['task_type'],
+                'timestamp': entry['timestamp'],
+                'size': entry['size'],
+                'expiresIn': max(0, round(entry['expires_at'] - now))
+            }
+            for key, entry in page
+        ],
+        'limit': limit,
+        # Counting prefix matches would need a scan, so no total for those
+        'total': None if key_prefix else cache.count(task_type),
+        'nextCursor': next_cursor
     })
 
-@app.route('/api/task', methods=['POST'])
-def process_task():
+@app.route('/api/cache/hot', methods=['GET'])
+def cache_hot_keys():
+    """Most looked-up cache keys (approximate, from a Space-Saving sketch)"""
+    try:
+        limit = min(CACHE_HOT_KEYS, max(1, int(request.args.get('limit', 10))))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    return jsonify({'hotKeys': cache.hot_keys(limit)})
+
+@app.route('/api/cache/invalidate', methods=['POST'])
+def invalidate_cache():
     """
-    Process a business task using Claude Code
+    Drop matching entries instead of clearing the whole cache
     
-    Expected JSON payload:
+    Expected JSON payload (at least one field; both must match if given):
     {
-        "businessId": "biz-001",
-        "content": "Task description",
-        "type": "financial|marketing|strategy|operations|general",
-        "useCache": true
+        "type": "financial",
+        "keyPrefix": "3fa9"
     }
     """
+    data = request.json or {}
+    task_type = data.get('type') or None
+    key_prefix = data.get('keyPrefix') or None
+    if not task_type and not key_prefix:
+        return jsonify({'error': 'Provide type and/or keyPrefix'}), 400
+    
+    removed = cache.invalidate(task_type, key_prefix)
+    logger.info(f"Cache invalidated (type={task_type}, prefix={key_prefix}): {removed}")
+    return jsonify({'success': True, **removed})
+
+@app.route('/api/cache/clear', methods=['POST'])
+def clear_cache():
+    """Clear the cache"""
+    if not cache.clear():
+        return jsonify({
+            'success': False,
+            'message': 'Memory cache cleared; the persistent cache could not be cleared'
+        }), 503
+    return jsonify({'success': True, 'message': 'Cache cleared'})
+
+@app.route('/api/test', methods=['GET'])
+def test_claude():
+    """Test Claude CLI directly"""
+    try:
+        result = claude_service.query("What is 2+2?")
+        return jsonify({
+            'success': True,
+            'result': result,
+            'message': 'Claude CLI is working!'
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'message': 'Claude CLI test failed'
+        })
+
+def requested_stream_format(data: Dict[str, Any]) -> Optional[str]:
+    """Return 'sse' or 'ndjson' when the client asked for a streamed response"""
+    accept = request.headers.get('Accept', '')
+    if 'text/event-stream' in accept:
+        return 'sse'
+    if 'application/x-ndjson' in accept:
+        return 'ndjson'
+    if data.get('stream'):
+        return 'ndjson' if data.get('streamFormat') == 'ndjson' else 'sse'
+    return None
+
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'  # deflate, no name or mtime
+
+def result_response(payload: Dict[str, Any], status: int, field: str) -> Response:
+    """
+    JSON response for a (possibly cached) result with conditional-request and
+    compression support
+
+    When the body's result is the cache entry named by payload["cacheKey"] it
+    gets a weak ETag of key, entry version and a checksum of the per-request
+    fields around the result (businessId, cached, credits, similarity...), and
+    a matching If-None-Match is answered with 304. Large bodies are gzip- or brotli-compressed; for a
+    cached entry gzip splices the stored deflated prefix with the few bytes
+    that differ per request.
+    """
+    entry = cache.peek(payload['cacheKey']) if status == 200 and payload.get('cacheKey') else None
+    if entry is not None and (entry['result'] is not payload.get(field) or result_field(entry['task_type']) != field):
+        entry = None  # replaced since this request read it
+
+    # Serialize as '{"<field>":<result>' + rest so the prefix matches deflate_result()
+    if field in payload:
+        rest = {name: value for name, value in payload.items() if name != field}
+        prefix = '{' + json.dumps(field) + ':' + json.dumps(payload[field], separators=(',', ':'))
+        suffix = (',' + json.dumps(rest, sort_keys=True, separators=(',', ':'))[1:]) if rest else '}'
+    else:
+        prefix, suffix = '', json.dumps(payload, sort_keys=True, separators=(',', ':'))
+
+    headers = {'Vary': 'Accept-Encoding'}
+    if entry is not None:
+        # The result is covered by key and version; the suffix holds the rest of the body
+        etag = (f'{payload["cacheKey"]}-v{zlib.crc32(entry["timestamp"].encode()):08x}'
+                f'-{zlib.crc32(suffix.encode("utf-8")):08x}')
+        headers['ETag'] = f'W/"{etag}"'
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+
+    accepts = request.accept_encodings
+    deflated = entry.get('deflated') if entry is not None else None
+    if deflated is not None and accepts['gzip']:
+        body = splice_gzip(deflated, suffix.encode('utf-8'))
+        headers['Content-Encoding'] = 'gzip'
+    else:
+        body = (prefix + suffix).encode('utf-8')
+        if len(body) >= COMPRESS_MIN_BYTES:
+            if brotli is not None and accepts['br'] and accepts['br'] >= accepts['gzip']:
+                body = brotli.compress(body, quality=BROTLI_QUALITY)
+                headers['Content-Encoding'] = 'br'
+            elif accepts['gzip']:
+                body = splice_gzip((b'', 0, 0), body)
+                headers['Content-Encoding'] = 'gzip'
+    return Response(body, status=status, mimetype='application/json', headers=headers)
+
+def splice_gzip(deflated: Tuple[bytes, int, int], tail: bytes) -> bytes:
+    """Complete a gzip member from a sync-flushed deflate prefix and the remaining bytes"""
+    prefix, crc, length = deflated
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    ending = compressor.compress(tail) + compressor.flush()
+    trailer = struct.pack('<II', zlib.crc32(tail, crc) & 0xffffffff, (length + len(tail)) & 0xffffffff)
+    return GZIP_HEADER + prefix + ending + trailer
+
+def stream_response(events: Iterator[Tuple[str, Dict[str, Any]]], stream_format: str) -> Response:
+    """Encode (event, payload) pairs as Server-Sent Events or NDJSON lines"""
+    endpoint, started = g.get('metrics_endpoint'), g.get('metrics_started')
+    g.metrics_streaming = True
+
+    def encode():
+        try:
+            for event, payload in events:
+                if stream_format == 'sse':
+                    yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+                else:
+                    yield json.dumps({'event': event, **payload}) + '\n'
+        finally:
+            if started is not None:
+                observe_request(endpoint, started)
+
+    return Response(
+        stream_with_context(encode()),
+        mimetype='text/event-stream' if stream_format == 'sse' else 'application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def stream_task_events(prompt: str, contextual_prompt: str, task_type: str,
+                       cache_key: str, business_id: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Stream a task's CLI output, then cache and report the full result"""
+    def produce():
+        # Cached by the producer, so the result is kept even if the request
+        # that started the stream disconnects while others are still following
+        for kind, text in claude_service.stream(contextual_prompt):
+            if kind == 'result':
+                store_result(cache_key, prompt, task_type, text)
+            yield kind, text
+
+    # Identical streams already in flight are joined rather than started again
+    events, coalesced = single_flight.stream(cache_key, produce, source='task_stream')
+    result = ''
+    try:
+        yield 'start', {'cacheKey': cache_key, 'businessId': business_id, 'coalesced': coalesced}
+        for kind, text in events:
+            if kind == 'delta':
+                yield 'delta', {'text': text}
+            else:
+                result = text
+    except Exception as e:
+        logger.error(f"Error streaming task: {e}")
+        yield 'fallback', {
+            'success': True,
+            'result': get_fallback_response(task_type, prompt),
+            'fallback': True,
+            'error': str(e),
+            'credits': 5
+        }
+        return
+    finally:
+        events.close()
+
+    yield 'done', {
+        'success': True,
+        'result': result,
+        'cached': False,
+        'coalesced': coalesced,
+        'businessId': business_id,
+        'credits': 10
+    }
+
+def stream_generate(data: Dict[str, Any], stream_format: str) -> Response:
+    """Serve a generation as a stream of events, short-circuiting cache hits"""
+    content_type, output_format, context = generation_inputs(data)
+    if output_format not in ClaudeCodeService.OUTPUT_FORMATS:
+        return jsonify({'error': f"Unknown format: {output_format}"}), 400
+    
+    cache_key = claude_service.get_generation_cache_key(content_type, output_format, context)
+    cached_result = lookup_generation(cache_key, content_type) if data.get('useCache', True) else None
+    if cached_result is not None:
+        return stream_response(iter([('done', {
+            'success': True,
+            'content': cached_result['result'],
+            'type': content_type,
+            'cached': True,
+            'cacheKey': cache_key,
+            'credits': 1
+        })]), stream_format)
+    
+    prompt = build_generation_prompt(content_type, context)
+    return stream_response(
+        stream_generate_events(prompt, content_type, output_format, cache_key), stream_format
+    )
+
+def stream_generate_events(prompt: str, content_type: str, output_format: str,
+                           cache_key: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Stream generated content, parsing it as JSON at the end if requested"""
+    yield 'start', {'type': content_type, 'cacheKey': cache_key}
+    result = ''
+    try:
+        for kind, text in claude_service.stream(prompt):
+            if kind == 'delta':
+                yield 'delta', {'text': text}
+            else:
+                result = text
+    except Exception as e:
+        logger.error(f"Error streaming content: {e}")
+        yield 'error', {'success': False, 'error': str(e)}
+        return
+
+    if output_format == 'json':
+        try:
+            result = json.loads(result)
+        except ValueError:
+            pass  # Return as text if JSON parsing fails
+    cache.set(cache_key, result, f"generate:{content_type}")
+    yield 'done', {
+        'success': True,
+        'content': result,
+        'type': content_type,
+        'cached': False,
+        'credits': 15
+    }
+
+def find_cached(prompt: str, task_type: str, endpoint: str,
+                allow_similar: bool = True) -> Tuple[str, Optional[Dict[str, Any]], float]:
+    """
+    Look up a prompt's cached result, falling back to a near-duplicate match
+
+    Returns (cache key, entry or None, similarity). On a miss the key is the
+    prompt's own key, ready for storing the fresh result.
+    """
+    cache_key = claude_service.get_cache_key(prompt, task_type)
+    entry = cache.get(cache_key)
+    if entry is not None:
+        CACHE_LOOKUPS.labels(endpoint, task_label(task_type), 'hit').inc()
+        return cache_key, entry, 1.0
+
+    if near_duplicates is not None and allow_similar:
+        match = near_duplicates.lookup(prompt, task_type)
+        if match is not None:
+            # The exact key's miss is already counted; don't count this as a lookup too
+            similar_entry = cache.peek(match[0])
+            if similar_entry is not None:
+                CACHE_LOOKUPS.labels(endpoint, task_label(task_type), 'near_hit').inc()
+                return match[0], similar_entry, round(match[1], 3)
+
+    CACHE_LOOKUPS.labels(endpoint, task_label(task_type), 'miss').inc()
+    return cache_key, None, 0.0
+
+def lookup_generation(cache_key: str, content_type: str) -> Optional[Dict[str, Any]]:
+    """Cache lookup for /api/generate, recorded under the generate endpoint"""
+    entry = cache.get(cache_key)
+    CACHE_LOOKUPS.labels('generate', task_label(content_type), 'miss' if entry is None else 'hit').inc()
+    return entry
+
+def store_result(cache_key: str, prompt: str, task_type: str, result: Any):
+    """Cache a fresh task result with its prompt, which indexes it for near-duplicate lookups"""
+    cache.set(cache_key, result, task_type, prompt=prompt)
+
+def run_task(data: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    """Process a task payload and return (response body, HTTP status)"""
     try:
-        data = request.json
-        if not data or 'content' not in data:
-            return jsonify({'error': 'Missing content in request'}), 400
-        
         prompt = data['content']
-        task_type = data.get('type', 'general')
+        task_type = task_type_of(data)
         use_cache = data.get('useCache', True)
         business_id = data.get('businessId', 'unknown')
         
         # Check cache if enabled
-        cache_key = claude_service.get_cache_key(prompt, task_type)
-        if use_cache and cache_key in cache:
-            global cache_hits
-            cache_hits += 1
+        if use_cache:
+            hit_key, cached_result, similarity = find_cached(
+                prompt, task_type, 'task', data.get('allowSimilar', True)
+            )
+        else:
+            cached_result = None
+        if cached_result is not None:
             logger.info(f"Cache hit for task: {prompt[:50]}...")
-            cached_result = cache[cache_key]
-            return jsonify({
+            return {
                 'success': True,
                 'result': cached_result['result'],
                 'cached': True,
-                'cacheKey': cache_key,
+                'similarity': similarity,
+                'cacheKey': hit_key,
                 'businessId': business_id,
                 'credits': 1  # Reduced credits for cached result
-            })
+            }, 200
+        
+        cache_key = claude_service.get_cache_key(prompt, task_type)
         
         # Build contextual prompt based on task type
         contextual_prompt = build_contextual_prompt(prompt, task_type)
         
-        # Query Claude Code
-        global cache_misses
-        cache_misses += 1
-        logger.info(f"Processing task: {prompt[:50]}...")
+        def run_query():
+            # Query Claude Code and cache the result
+            logger.info(f"Processing task: {prompt[:50]}...")
+            result = query_task_prompt(contextual_prompt, task_type, data.get('businessId'))
+            store_result(cache_key, prompt, task_type, result)
+            return result
         
-        result = claude_service.query(contextual_prompt)
-        
-        # Cache the result
-        cache[cache_key] = {
-            'result': result,
-            'timestamp': datetime.now().isoformat(),
-            'task_type': task_type
-        }
+        # Identical requests already in flight wait for that result instead
+        result, coalesced = single_flight.do(cache_key, run_query, source='task')
         
-        return jsonify({
+        return {
             'success': True,
             'result': result,
             'cached': False,
+            'coalesced': coalesced,
+            'cacheKey': cache_key,
             'businessId': business_id,
             'credits': 10  # Full credits for new processing
-        })
+        }, 200
         
     except Exception as e:
         logger.error(f"Error processing task: {e}")
         # Return fallback response
-        fallback = get_fallback_response(data.get('type', 'general'), data.get('content', ''))
-        return jsonify({
+        fallback = get_fallback_response(task_type_of(data), data.get('content', ''))
+        return {
             'success': True,
             'result': fallback,
             'fallback': True,
             'error': str(e),
             'credits': 5
-        })
+        }, 200
 
-@app.route('/api/bulk-task', methods=['POST'])
-def process_bulk_tasks():
-    """
-    Process multiple tasks across different businesses
+def stream_task(data: Dict[str, Any], stream_format: str) -> Response:
+    """Serve a task as a stream of events, short-circuiting cache hits"""
+    prompt = data['content']
+    task_type = task_type_of(data)
+    business_id = data.get('businessId', 'unknown')
     
-    Expected JSON payload:
-    {
-        "businessIds": ["biz-001", "biz-002"],
-        "content": "Task description",
-        "type": "general"
-    }
-    """
+    cache_key = claude_service.get_cache_key(prompt, task_type)
+    if data.get('useCache', True):
+        hit_key, cached_result, similarity = find_cached(
+            prompt, task_type, 'task', data.get('allowSimilar', True)
+        )
+    else:
+        cached_result = None
+    if cached_result is not None:
+        logger.info(f"Cache hit for task: {prompt[:50]}...")
+        return stream_response(iter([('done', {
+            'success': True,
+            'result': cached_result['result'],
+            'cached': True,
+            'similarity': similarity,
+            'cacheKey': hit_key,
+            'businessId': business_id,
+            'credits': 1
+        })]), stream_format)
+    
+    contextual_prompt = build_contextual_prompt(prompt, task_type)
+    return stream_response(
+        stream_task_events(prompt, contextual_prompt, task_type, cache_key, business_id),
+        stream_format
+    )
+
+def run_bulk(data: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    """Process a bulk payload and return (response body, HTTP status)"""
+    invalid = bulk_payload_error(data)
+    if invalid:
+        return {'error': invalid}, 400
     try:
-        data = request.json
         business_ids = data.get('businessIds', [])
         content = data.get('content', '')
-        task_type = data.get('type', 'general')
+        task_type = task_type_of(data)
         
-        if not business_ids or not content:
-            return jsonify({'error': 'Missing businessIds or content'}), 400
+        assignments = [(business_id, content, task_type) for business_id in business_ids]
+        for task in data.get('tasks', []):
+            assignments.append((
+                task.get('businessId', 'unknown'),
+                task.get('content', content),
+                str(task.get('type') or task_type)
+            ))
         
-        results = []
+        deadline = time.monotonic() + float(data.get('timeoutSeconds', BULK_DEFAULT_DEADLINE))
         
-        # Process for each business (could be parallelized)
-        for business_id in business_ids:
-            try:
-                # Check cache first
-                cache_key = claude_service.get_cache_key(content, task_type)
-                if cache_key in cache:
-                    results.append({
-                        'businessId': business_id,
-                        'success': True,
-                        'result': cache[cache_key]['result'],
-                        'cached': True
-                    })
-                else:
-                    # Query Claude
-                    contextual_prompt = build_contextual_prompt(content, task_type)
-                    result = claude_service.query(contextual_prompt)
-                    
-                    # Cache it
-                    cache[cache_key] = {
-                        'result': result,
-                        'timestamp': datetime.now().isoformat(),
-                        'task_type': task_type
-                    }
-                    
-                    results.append({
-                        'businessId': business_id,
-                        'success': True,
-                        'result': result,
-                        'cached': False
-                    })
-                    
-            except Exception as e:
-                results.append({
-                    'businessId': business_id,
-                    'success': False,
-                    'error': str(e)
-                })
+        # Group businesses by cache key so each unique prompt runs once
+        assignment_keys = []
+        groups: "OrderedDict[str, tuple]" = OrderedDict()
+        for _, item_content, item_type in assignments:
+            cache_key = claude_service.get_cache_key(item_content, item_type)
+            assignment_keys.append(cache_key)
+            groups.setdefault(cache_key, (item_content, item_type))
         
-        return jsonify({
+        outcomes = {}
+        futures = {}
+        batch_group = f"bulk:{uuid.uuid4().hex}"  # this request's prompts may share batches
+        for cache_key, (item_content, item_type) in groups.items():
+            _, cached_result, similarity = find_cached(
+                item_content, item_type, 'bulk', data.get('allowSimilar', True)
+            )
+            if cached_result is not None:
+                outcomes[cache_key] = {
+                    'success': True,
+                    'result': cached_result['result'],
+                    'cached': True,
+                    'similarity': similarity
+                }
+            else:
+                futures[cache_key] = bulk_executor.submit(
+                    run_bulk_prompt, cache_key, item_content, item_type, batch_group
+                )
+        
+        if futures:
+            wait_futures(futures.values(), timeout=max(0.0, deadline - time.monotonic()))
+        for cache_key, future in futures.items():
+            if not future.done():
+                # Still running work finishes in the background and fills the cache
+                future.cancel()
+                outcomes[cache_key] = {'success': False, 'error': 'Deadline exceeded'}
+            elif future.exception() is not None:
+                outcomes[cache_key] = {'success': False, 'error': str(future.exception())}
+            else:
+                outcomes[cache_key] = {'success': True, 'result': future.result(), 'cached': False}
+        
+        # Fan results back out in request order
+        results = []
+        served = set()
+        for (business_id, _, _), cache_key in zip(assignments, assignment_keys):
+            outcome = outcomes[cache_key]
+            item = {'businessId': business_id, **outcome}
+            if outcome['success'] and cache_key in served:
+                item['cached'] = True
+            served.add(cache_key)
+            results.append(item)
+        
+        return {
             'success': True,
             'results': results,
-            'totalCredits': len(business_ids) * 5
-        })
+            'uniquePrompts': len(groups),
+            'totalCredits': len(assignments) * 5
+        }, 200
         
     except Exception as e:
         logger.error(f"Error in bulk processing: {e}")
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
 
-@app.route('/api/generate', methods=['POST'])
-def generate_content():
-    """
-    Generate specific content using Claude Code
-    
-    Expected JSON payload:
-    {
-        "type": "marketing|email|report|code",
-        "context": {...},
-        "format": "text|json"
-    }
-    """
+def run_generate(data: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    """Process a generation payload and return (response body, HTTP status)"""
     try:
-        data = request.json
-        content_type = data.get('type', 'general')
-        context = data.get('context', {})
-        output_format = data.get('format', 'text')
+        content_type, output_format, context = generation_inputs(data)
+        if output_format not in ClaudeCodeService.OUTPUT_FORMATS:
+            return {'error': f"Unknown format: {output_format}"}, 400
+        
+        # Check cache; JSON content is stored parsed so a hit skips json.loads
+        cache_key = claude_service.get_generation_cache_key(content_type, output_format, context)
+        cached_result = lookup_generation(cache_key, content_type) if data.get('useCache', True) else None
+        if cached_result is not None:
+            return {
+                'success': True,
+                'content': cached_result['result'],
+                'type': content_type,
+                'cached': True,
+                'cacheKey': cache_key,
+                'credits': 1
+            }, 200
         
         # Build generation prompt
         prompt = build_generation_prompt(content_type, context)
         
-        # Query Claude
-        result = claude_service.query(prompt, output_format)
+        def run_query():
+            result = claude_service.query(prompt, output_format)
+            
+            # Parse JSON if requested
+            if output_format == 'json':
+                try:
+                    result = json.loads(result)
+                except ValueError:
+                    pass  # Return as text if JSON parsing fails
+            
+            cache.set(cache_key, result, f"generate:{content_type}")
+            return result
         
-        # Parse JSON if requested
-        if output_format == 'json':
-            try:
-                result = json.loads(result)
-            except:
-                pass  # Return as text if JSON parsing fails
+        # Query Claude, sharing the result with identical in-flight requests
+        result, coalesced = single_flight.do(cache_key, run_query, source='generate')
         
-        return jsonify({
+        return {
             'success': True,
             'content': result,
             'type': content_type,
+            'cached': False,
+            'coalesced': coalesced,
+            'cacheKey': cache_key,
             'credits': 15
-        })
+        }, 200
         
+    except CLIUnavailableError as e:
+        logger.warning(f"Generation rejected: {e}")
+        return {'error': str(e)}, 503
     except Exception as e:
         logger.error(f"Error generating content: {e}")
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
 
-@app.route('/api/cache/stats', methods=['GET'])
-def cache_stats():
-    """Get cache statistics"""
-    return jsonify({
-        'cacheSize': len(cache),
-        'cacheHits': cache_hits,
-        'cacheMisses': cache_misses,
-        'hitRate': f"{(cache_hits / (cache_hits + cache_misses) * 100):.1f}%" if (cache_hits + cache_misses) > 0 else "0%",
-        'entries': [
-            {
-                'key': key,
-                'timestamp': value['timestamp'],
-                'type': value['task_type']
-            }
-            for key, value in list(cache.items())[:10]  # Show last 10 entries
-        ]
-    })
+def is_local_url(url: str) -> bool:
+    """Only loopback http(s) URLs are accepted as job callbacks"""
+    parsed = urlparse(url)
+    return parsed.scheme in ('http', 'https') and parsed.hostname in ('localhost', '127.0.0.1', '::1')
 
-@app.route('/api/cache/clear', methods=['POST'])
-def clear_cache():
-    """Clear the cache"""
-    global cache, cache_hits, cache_misses
-    cache = {}
-    cache_hits = 0
-    cache_misses = 0
-    return jsonify({'success': True, 'message': 'Cache cleared'})
+def deliver_job_callback(job: Dict[str, Any]):
+    """POST a finished job to its callback URL, retrying transient failures"""
+    body = json.dumps(job).encode('utf-8')
+    for attempt in range(JOB_CALLBACK_ATTEMPTS):
+        try:
+            callback_request = urllib.request.Request(
+                job['callbackUrl'], data=body,
+                headers={'Content-Type': 'application/json'}, method='POST'
+            )
+            with urllib.request.urlopen(callback_request, timeout=5) as response:
+                return {'delivered': True, 'status': response.status, 'attempts': attempt + 1}
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning(f"Job callback to {job['callbackUrl']} failed: {e}")
+            if attempt + 1 < JOB_CALLBACK_ATTEMPTS:
+                time.sleep(2 ** attempt)
+    return {'delivered': False, 'attempts': JOB_CALLBACK_ATTEMPTS}
 
-@app.route('/api/test', methods=['GET'])
-def test_claude():
-    """Test Claude CLI directly"""
-    try:
-        result = claude_service.query("What is 2+2?")
-        return jsonify({
-            'success': True,
-            'result': result,
-            'message': 'Claude CLI is working!'
-        })
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': str(e),
-            'message': 'Claude CLI test failed'
-        })
+def query_task_prompt(contextual_prompt: str, task_type: str, batch_group: Optional[str] = None) -> str:
+    """
+    Query Claude, routing short prompts of batchable types through the
+    batcher. Only prompts with the same batch_group (a businessId or one bulk
+    request) share a batch; without one the prompt is never batched
+    """
+    if (micro_batcher is not None and batch_group and task_type in BATCH_TASK_TYPES
+            and len(contextual_prompt) <= BATCH_MAX_PROMPT_CHARS):
+        return micro_batcher.query(contextual_prompt, batch_group)
+    return claude_service.query(contextual_prompt)
+
+def run_bulk_prompt(cache_key: str, content: str, task_type: str, batch_group: str) -> str:
+    """Run one unique bulk prompt on a worker thread and cache its result"""
+    def run_query():
+        result = query_task_prompt(build_contextual_prompt(content, task_type), task_type, batch_group)
+        store_result(cache_key, content, task_type, result)
+        return result
+
+    result, _ = single_flight.do(cache_key, run_query, source='bulk')
+    return result
 
 def build_contextual_prompt(prompt: str, task_type: str) -> str:
     """Build a contextual prompt based on task type"""
@@ -335,16 +3188,73 @@ def build_contextual_prompt(prompt: str, task_type: str) -> str:
 
 def build_generation_prompt(content_type: str, context: Dict) -> str:
     """Build a generation prompt based on content type"""
+    context_json = canonical_json(context)
     templates = {
-        'marketing': f"Create engaging marketing content for: {json.dumps(context)}",
-        'email': f"Write a professional business email based on: {json.dumps(context)}",
-        'report': f"Generate a business report for: {json.dumps(context)}",
-        'code': f"Generate clean, commented code for: {json.dumps(context)}"
+        'marketing': f"Create engaging marketing content for: {context_json}",
+        'email': f"Write a professional business email based on: {context_json}",
+        'report': f"Generate a business report for: {context_json}",
+        'code': f"Generate clean, commented code for: {context_json}"
     }
-    return templates.get(content_type, f"Generate {content_type} content: {json.dumps(context)}")
+    return templates.get(content_type, f"Generate {content_type} content: {context_json}")
+
+def generation_inputs(data: Dict[str, Any]) -> Tuple[str, str, Any]:
+    """
+    (content type, output format, context) of a generation payload. Type and
+    format are case-folded here, once, so the cache key and the prompt
+    template always see the same values
+    """
+    content_type = str(data.get('type') or 'general').strip().lower()
+    output_format = str(data.get('format') or 'text').strip().lower()
+    return content_type, output_format, data.get('context', {})
+
+def canonical_json(value: Any) -> str:
+    """Key-order independent JSON with Unicode-normalized strings"""
+    def normalize(item):
+        if isinstance(item, str):
+            # Whitespace inside values is user content; leave it alone
+            return unicodedata.normalize('NFKC', item)
+        if isinstance(item, dict):
+            return {str(key): normalize(val) for key, val in item.items()}
+        if isinstance(item, (list, tuple)):
+            return [normalize(val) for val in item]
+        return item
+
+    return json.dumps(normalize(value), sort_keys=True, separators=(', ', ': '), ensure_ascii=False)
+
+JOB_RUNNERS = {
+    'task': run_task,
+    'bulk': run_bulk,
+    'generate': run_generate
+}
+
+def bulk_payload_error(data: Dict[str, Any]) -> Optional[str]:
+    """Why a bulk payload is malformed, or None if every business has content"""
+    business_ids = data.get('businessIds', [])
+    tasks = data.get('tasks', [])
+    if not isinstance(business_ids, list) or not isinstance(tasks, list) \
+            or not all(isinstance(task, dict) for task in tasks):
+        return 'businessIds must be a list and tasks a list of objects'
+    content = data.get('content', '')
+    contents = [content for _ in business_ids] + [task.get('content', content) for task in tasks]
+    if not contents or not all(contents):
+        return 'Missing businessIds or content'
+    return None
+
+def validate_job_payload(kind: str, payload: Dict[str, Any]) -> Optional[str]:
+    """The 400 error the matching sync endpoint would give, checked before queueing"""
+    if kind == 'task' and not payload.get('content'):
+        return 'Missing content in request'
+    if kind == 'bulk':
+        return bulk_payload_error(payload)
+    if kind == 'generate':
+        output_format = generation_inputs(payload)[1]
+        if output_format not in ClaudeCodeService.OUTPUT_FORMATS:
+            return f"Unknown format: {output_format}"
+    return None
 
 def get_fallback_response(task_type: str, content: str) -> str:
     """Get a fallback response when Claude is unavailable"""
+    FALLBACKS.labels(task_label(task_type)).inc()
     fallbacks = {
         'financial': "Based on the financial query, I recommend reviewing your cash flow, optimizing expenses, and maintaining a 20% profit margin target.",
         'marketing': "For this marketing challenge, consider focusing on your target audience, creating engaging content, and measuring ROI across channels.",
@@ -354,12 +3264,43 @@ def get_fallback_response(task_type: str, content: str) -> str:
     }
     return fallbacks.get(task_type, f"Processing your request: {content[:100]}")
 
+def serve_production(port: int):
+    """
+    Serve the app on gevent's WSGI server. Each request is a greenlet, so a
+    request waiting on the CLI costs a few KB instead of an OS thread. On
+    SIGTERM/SIGINT the listener closes, in-flight requests get SHUTDOWN_GRACE
+    seconds to finish, and any CLI process still running after that is killed.
+    """
+    import signal
+    import gevent
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    server = WSGIServer(('0.0.0.0', port), app, spawn=Pool(SERVER_MAX_CONNECTIONS))
+    stopping_since = []
+
+    def on_signal():
+        if not stopping_since:
+            logger.info(f"Shutting down, draining in-flight requests for up to {SHUTDOWN_GRACE:.0f}s")
+            stopping_since.append(time.monotonic())
+            server.close()
+
+    gevent.signal_handler(signal.SIGTERM, on_signal)
+    gevent.signal_handler(signal.SIGINT, on_signal)
+    # Returns once the listener is closed and in-flight handlers finished or
+    # were killed at the end of the grace period
+    server.serve_forever(stop_timeout=SHUTDOWN_GRACE)
+
+    elapsed = time.monotonic() - stopping_since[0] if stopping_since else 0.0
+    killed = cli_pool.drain(max(0.0, SHUTDOWN_GRACE - elapsed))
+    if killed:
+        logger.warning(f"Killed {killed} Claude CLI process(es) still running after the grace period")
+    logger.info("Shutdown complete")
+
 if __name__ == '__main__':
-    import sys
-    
     # Check if Claude CLI is available
     try:
-        result = subprocess.run(['claude', '--version'], capture_output=True, text=True)
+        result = subprocess.run([CLAUDE_BIN, '--version'], capture_output=True, text=True)
         if result.returncode == 0:
             logger.info(f"✅ Claude CLI found: {result.stdout.strip()}")
         else:
@@ -368,18 +3309,25 @@ if __name__ == '__main__':
         logger.warning("⚠️ Claude CLI not available, will use fallback responses")
     
     # Get port from command line or use default
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    positional = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    port = int(positional[0]) if positional else 5000
     
     logger.info(f"""
-🚀 Claude Code API Server Starting (with uv)
+🚀 Claude Code API Server Starting (with uv, {SERVER_MODE} mode)
 📍 URL: http://localhost:{port}
 📡 Endpoints:
    - POST /api/task - Process single task
    - POST /api/bulk-task - Process multiple tasks
    - POST /api/generate - Generate content
+   - POST /api/jobs - Submit a background job
+   - GET /api/jobs/<id> - Poll a background job
    - GET /api/cache/stats - Cache statistics
+   - GET /api/cache/entries - Page through cache entries
+   - GET /api/cache/hot - Most looked-up cache keys
+   - POST /api/cache/invalidate - Drop entries by type or key prefix
    - POST /api/cache/clear - Clear cache
    - GET /api/test - Test Claude CLI
+   - GET /metrics - Prometheus metrics
    - GET /health - Health check
 
 💡 Frontend Integration:
@@ -397,4 +3345,8 @@ if __name__ == '__main__':
    curl http://localhost:{port}/api/test
 """)
     
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    if SERVER_MODE == 'production':
+        serve_production(port)
+    else:
+        # Development: Werkzeug with the reloader; run with --production to serve for real
+        app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file